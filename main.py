@@ -2,19 +2,35 @@ import os, sys, time, traceback, signal
 
 from src.constants import *
 from src.errors import *
-from src import database, rpc, blocks, credit, payments, wallet, log
+from src import database, rpc, balances, blocks, credit, payments, consolidate, schedule, stages, wallet, daemon, events, metrics, log
+from src.stages import Stage
 
 def self_test():
     if not database.check_connection():
         if not database.connection_init():
             return False
-    if not rpc.check_rpc():
+    # wallet-rpc is busy while it recovers, don't count that as a failure
+    if not rpc.check_rpc(check_wallet=not wallet.recovery_in_progress()):
         return False
     return True
 
 
+def run_db_stages():
+    """Run the stages that only need the database"""
+    log.message('Calculating credits')
+    with metrics.stage('calculate_credits'):
+        credit.calculate()
+
+    log.message('Unlocking credits')
+    with metrics.stage('unlock_credits'):
+        credit.unlock()
+
+
 class Payoutd:
     kill_now = False
+    # set when the last sleep was cut short by a change to a watched table
+    tables_changed = False
+
     def __init__(self):
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
@@ -22,9 +38,24 @@ class Payoutd:
 
     def exit_gracefully(self, signum, frame):
         self.kill_now = True
+        events.post('exit')
 
     def handle_sighup(self, signum, frame):
-        log.open_log_files()
+        events.post('sighup')
+
+    def sleep(self, seconds, wake=True):
+        """Sleep up to seconds, or with wake until something worth a new run happens"""
+        deadline = time.time() + seconds
+        self.tables_changed = False
+        while not self.kill_now and time.time() < deadline:
+            reasons = events.wait(deadline - time.time(), watch_height=wake)
+            if 'sighup' in reasons:
+                log.open_log_files()
+            reasons = [reason for reason in reasons if reason not in ('sighup', 'exit')]
+            if wake and len(reasons):
+                log.message('Woken up by %s' % (', '.join(reasons),))
+                self.tables_changed = any([reason in WAKEUP_TABLES for reason in reasons])
+                return
 
 
 if __name__== "__main__":
@@ -35,6 +66,7 @@ if __name__== "__main__":
 
         if os.path.isfile(pid_file):
             log.error("Payoutd is already running, exiting")
+            log.flush()
             os._exit(1)
 
         open(pid_file, 'w').write(str(pid))
@@ -42,6 +74,12 @@ if __name__== "__main__":
         log.message('Payoutd initializing, python version: %s, pid: %d' % (sys.version, pid))
         payoutd = Payoutd()
 
+        if METRICS_ENABLED:
+            metrics.start_server()
+            log.message('Serving metrics on http://%s:%d/metrics' % (METRICS_HOST, METRICS_PORT))
+
+        triggers_installed = False
+
         while not payoutd.kill_now:
 
             # newline for clarity
@@ -49,44 +87,96 @@ if __name__== "__main__":
 
             if not self_test():
                 log.error('Failed self test, sleeping %s seconds...' % (PAYOUTD_SELF_TEST_TIMEOUT,))
-                for i in range(PAYOUTD_SELF_TEST_TIMEOUT):
-                    if payoutd.kill_now:
-                        break
-                    time.sleep(1)
+                payoutd.sleep(PAYOUTD_SELF_TEST_TIMEOUT, wake=False)
                 continue
 
+            # before anything writes credits or payments
+            balances.ensure_ledger()
+
+            if WAKEUP_LISTEN and not triggers_installed:
+                triggers_installed = events.install_triggers()
+
             try:
+                if wallet.recovery_in_progress():
+                    # only run the stages that don't need wallet-rpc
+                    log.message(wallet.recovery_status())
+                    run_db_stages()
+
+                    log.message('Sleeping for %s seconds...' % (PAYOUTD_TIMEOUT,))
+                    payoutd.sleep(PAYOUTD_TIMEOUT)
+                    continue
+
                 now = database.walltime_to_db_time(time.time())
                 height = wallet.get_wallet_height()
                 last_height = wallet.get_last_scan_height()
 
                 log.message('Current height: %s / Last scan height: %s' % (height, last_height))
                 if height == last_height:
+                    events.set_known_height(height)
+                    if payoutd.tables_changed:
+                        # new shares or blocks from the pool, credit them without waiting for the wallet
+                        run_db_stages()
                     log.message('No new blocks, sleeping for %s seconds...' % (PAYOUTD_TIMEOUT,))
-                    for i in range(PAYOUTD_TIMEOUT):
-                        if payoutd.kill_now:
-                            break
-                        time.sleep(1)
+                    payoutd.sleep(PAYOUTD_TIMEOUT)
                     continue
 
-                log.message('Checking for unlocked blocks')
-                blocks.unlock_blocks()
-
-                log.message('Calculating credits')
-                credit.calculate()
-
-                log.message('Unlocking credits')
-                credit.unlock()
-
-                if height % PAYMENTS_NETWORK_BLOCK_INTERVAL == 0:
-                    log.message('Making payments')
-                    payments.make_payments()
-
-                log.message('Unlocking payments')
-                payments.unlock()
+                cycle_start = time.time()
+
+                non_mature_blocks = blocks.get_non_mature_blocks()
+                payout_reason = schedule.payout_due(height, last_height)
+
+                # Blocks already TX_SEEN are credited while the wallet and
+                # daemon are asked about the rest, everything that writes to
+                # the database runs one stage at a time in this order:
+                # calculate_credits, unlock_blocks, unlock_credits,
+                # make_payments, unlock_payments, consolidate
+                cycle = [
+                    Stage('fetch_blocks', lambda results: blocks.prefetch_block_data(non_mature_blocks),
+                          uses_db=False, optional=True),
+                    Stage('calculate_credits', lambda results: credit.calculate(),
+                          message='Calculating credits'),
+                    Stage('unlock_blocks', lambda results: blocks.unlock_blocks(results['fetch_blocks']),
+                          after=('fetch_blocks', 'calculate_credits'), message='Checking for unlocked blocks'),
+                    Stage('unlock_credits', lambda results: credit.unlock(),
+                          after=('unlock_blocks',), message='Unlocking credits'),
+                ]
+
+                last_stage = 'unlock_credits'
+
+                if payout_reason is not None:
+                    cycle += [
+                        Stage('prefetch_payout', lambda results: payments.prefetch_payout(height),
+                              uses_db=False, optional=True),
+                        Stage('make_payments', lambda results: payments.make_payments(wallet_balance=results['prefetch_payout'], height=height),
+                              after=('unlock_credits', 'prefetch_payout'), message='Making payments, %s' % (payout_reason,)),
+                        Stage('record_payout', lambda results: schedule.update_last_payout_height(height, now),
+                              after=('make_payments',)),
+                    ]
+                    last_stage = 'record_payout'
+
+                cycle.append(Stage('unlock_payments', lambda results: payments.unlock(),
+                                   after=(last_stage,), message='Unlocking payments'))
+                last_stage = 'unlock_payments'
+
+                if CONSOLIDATION_ENABLED:
+                    cycle.append(Stage('consolidate', lambda results: consolidate.run(height),
+                                       after=(last_stage,), message='Checking wallet outputs'))
+                    last_stage = 'consolidate'
+
+                if METRICS_ENABLED:
+                    cycle.append(Stage('balance_gauges', lambda results: payments.update_balance_gauges(),
+                                       after=(last_stage,), optional=True))
+
+                stages.run(cycle)
+
+                metrics.observe('payoutd_stage_duration_seconds', time.time() - cycle_start, {'stage': 'cycle'})
 
                 log.message('Setting last scan height to %s' % (height,))
                 wallet.update_last_scan_height(height, now)
+                events.set_known_height(height)
+
+                rpc.log_stats()
+                daemon.log_stats()
 
             except RecoverableError as e:
                 log.error('Error during main loop, stopping until next run')
@@ -94,19 +184,14 @@ if __name__== "__main__":
 
             if not payoutd.kill_now:
                 log.message('Done, sleeping for %s seconds...' % (PAYOUTD_TIMEOUT,))
-                for i in range(PAYOUTD_TIMEOUT):
-                    if payoutd.kill_now:
-                        break
-                    time.sleep(1)
+                payoutd.sleep(PAYOUTD_TIMEOUT)
 
     except CriticalPaymentError:
         log.error('Critical payment error, halting payoutd')
         log.error(sys.exc_info())
+        log.flush()
         traceback.print_exception(*sys.exc_info())
-        for i in range(31556952): # sleep for 1 year
-            if payoutd.kill_now:
-                break
-            time.sleep(1)
+        payoutd.sleep(31556952, wake=False) # sleep for 1 year
 
     except:
         log.error('Exception:')
@@ -115,6 +200,7 @@ if __name__== "__main__":
 
     finally:
         log.message('Payoutd ending')
+        events.close_listener()
         database.close_connection()
         if os.path.isfile(pid_file):
             os.unlink(pid_file)
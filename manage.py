@@ -0,0 +1,67 @@
+import sys, time, argparse
+
+from src.constants import *
+from src import database, balances, payments, shares, wallet, log
+
+def backfill_rollups(args):
+    shares.backfill_rollups(database.walltime_to_db_time(time.time()))
+
+def verify_balances(args):
+    drift = balances.get_drift()
+
+    for uid, ledger, actual in drift:
+        log.error('Balance drift for uid %s (pending, matured, debited): ledger %s, history %s' % (uid, ledger, actual))
+
+    if not len(drift):
+        log.message('user_balances matches credits and payments history')
+        return
+
+    log.error('%d users have drifted balances' % (len(drift),))
+
+    if args.fix:
+        with database.transaction():
+            balances.rebuild_ledger()
+        log.message('Rebuilt user_balances from history')
+
+def plan_payments(args):
+    payments.make_payments(dry_run=True)
+
+def rescan_wallet(args):
+    log.message('Rescanning wallet, this can take a long time')
+    if wallet.rescan_bc():
+        log.message('Rescan complete')
+    else:
+        log.error('Rescan error')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Payoutd maintenance commands')
+    subparsers = parser.add_subparsers(dest='command')
+
+    subparser = subparsers.add_parser('backfill-rollups', help='Roll up existing share history into share_rollups')
+    subparser.set_defaults(func=backfill_rollups)
+
+    subparser = subparsers.add_parser('verify-balances', help='Compare user_balances against credits and payments history')
+    subparser.add_argument('--fix', action='store_true', help='Rebuild user_balances if it has drifted')
+    subparser.set_defaults(func=verify_balances)
+
+    subparser = subparsers.add_parser('plan-payments', help='Print the next payout plan without sending anything')
+    subparser.set_defaults(func=plan_payments)
+
+    subparser = subparsers.add_parser('rescan-wallet', help='Run a full rescan_blockchain on wallet-rpc')
+    subparser.set_defaults(func=rescan_wallet)
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    if not database.connection_init():
+        sys.exit(1)
+
+    balances.ensure_ledger()
+
+    try:
+        args.func(args)
+    finally:
+        database.close_connection()
@@ -0,0 +1,67 @@
+from functools import lru_cache
+
+from cryptonote.address import validate
+
+from .constants import *
+from . import database, log
+
+# user_addresses holds the validation result for each user's current
+# wallet address, a row whose wallet differs from users.wallet is stale
+
+table_ready = False
+
+def ensure_table():
+    global table_ready
+
+    if table_ready:
+        return
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS user_addresses (
+        uid INTEGER PRIMARY KEY,
+        wallet TEXT NOT NULL,
+        valid BOOLEAN NOT NULL,
+        addr_type TEXT
+    )
+    """)
+
+    table_ready = True
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def check(address):
+    """Get (valid, type) for address"""
+    wallet_info = validate(address, COIN_ADDRESS_PREFIXES)
+    return wallet_info['valid'], wallet_info['type'] if wallet_info['valid'] else None
+
+def get_address_type(uid, address, wallet_checked, valid, addr_type, save=True):
+    """
+    Get the address type of a user's wallet, or None if it is invalid
+
+    wallet_checked, valid and addr_type are the user's user_addresses row,
+    the address is only validated again if it changed since that row was
+    written. Invalid addresses are reported once, when first seen. Without
+    save the result is not written, i.e. for a dry run.
+    """
+    if wallet_checked == address:
+        return addr_type if valid else None
+
+    valid, addr_type = check(address)
+
+    if not save:
+        if not valid:
+            log.error('User with uid %d has an invalid address %s' % (uid, address))
+        return addr_type if valid else None
+
+    try:
+        database.execute("""
+        INSERT INTO user_addresses (uid, wallet, valid, addr_type) VALUES (%s, %s, %s, %s)
+        ON CONFLICT (uid) DO UPDATE SET wallet = EXCLUDED.wallet, valid = EXCLUDED.valid, addr_type = EXCLUDED.addr_type
+        """, (uid, address, valid, addr_type))
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+    if not valid:
+        log.error('User with uid %d has an invalid address %s, skipping their payments until it changes' % (uid, address))
+        return None
+
+    return addr_type
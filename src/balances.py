@@ -0,0 +1,212 @@
+from .constants import *
+from . import database, addresses, log
+
+# user_balances holds per uid totals of pending credits, matured credits
+# and debited payments (amount paid + fee, excluding orphaned payments).
+# Every write to credits or payments updates it in the same transaction.
+# ensure_ledger() has to run before the first such write: a new ledger is
+# built from the full history, which must not already hold the rows the
+# caller is about to add to it.
+
+ledger_ready = False
+
+# consolidation_fees holds the fee of every consolidation sweep. Sweeps
+# are paid by the pool, not by users, so they come out of the margin
+# between the wallet balance and what is owed.
+consolidation_fees_ready = False
+
+# per uid totals computed from the full credits and payments history
+FULL_SCAN_QUERY = """
+SELECT uid, SUM(pending), SUM(matured), SUM(debited)
+FROM (
+  SELECT
+  uid,
+  CASE WHEN status = 0 THEN COALESCE(amount_reward, 0) + COALESCE(amount_bonus, 0) + COALESCE(amount_dev, 0) ELSE 0 END AS pending,
+  CASE WHEN status = 1 THEN COALESCE(amount_reward, 0) + COALESCE(amount_bonus, 0) + COALESCE(amount_dev, 0) ELSE 0 END AS matured,
+  0 AS debited
+  FROM credits
+  UNION ALL
+  SELECT
+  uid,
+  0,
+  0,
+  COALESCE(amount_paid, 0) + COALESCE(amount_fee, 0)
+  FROM payments
+  WHERE status <> -1
+) t
+GROUP BY uid
+"""
+
+def ensure_ledger():
+    """Create the ledger if needed, building it from history, before any credits or payments are written"""
+    global ledger_ready
+
+    if ledger_ready:
+        return
+
+    database.execute("SELECT to_regclass('user_balances')")
+    exists = database.fetchone()[0] is not None
+
+    if not exists:
+        log.message('Creating user_balances ledger')
+        with database.transaction():
+            database.execute("""
+            CREATE TABLE user_balances (
+                uid INTEGER PRIMARY KEY,
+                pending BIGINT NOT NULL DEFAULT 0,
+                matured BIGINT NOT NULL DEFAULT 0,
+                debited BIGINT NOT NULL DEFAULT 0
+            )
+            """)
+            database.execute('CREATE INDEX user_balances_confirmed ON user_balances ((matured - debited)) WHERE matured - debited > 0')
+            rebuild_ledger()
+
+    ledger_ready = True
+
+def rebuild_ledger():
+    """Replace the ledger with totals computed from scratch"""
+    database.execute('DELETE FROM user_balances')
+    database.execute('INSERT INTO user_balances (uid, pending, matured, debited) ' + FULL_SCAN_QUERY)
+
+def get_drift():
+    """Get (uid, ledger, actual) for every uid where the ledger disagrees with history"""
+    ensure_ledger()
+
+    database.execute("""
+    SELECT
+    COALESCE(ledger.uid, actual.uid),
+    ledger.pending, ledger.matured, ledger.debited,
+    actual.pending, actual.matured, actual.debited
+    FROM user_balances AS ledger
+    FULL OUTER JOIN (""" + FULL_SCAN_QUERY + """) AS actual (uid, pending, matured, debited)
+    ON actual.uid = ledger.uid
+    WHERE ledger.uid IS NULL
+    OR actual.uid IS NULL
+    OR ledger.pending <> actual.pending
+    OR ledger.matured <> actual.matured
+    OR ledger.debited <> actual.debited
+    """)
+
+    return [(row[0], row[1:4], row[4:7]) for row in database.fetchall()]
+
+def add_block_credits(blk_id):
+    """Add the pending credits just inserted for blk_id"""
+    database.execute("""
+    INSERT INTO user_balances (uid, pending)
+    SELECT uid, SUM(COALESCE(amount_reward, 0) + COALESCE(amount_bonus, 0) + COALESCE(amount_dev, 0))
+    FROM credits
+    WHERE blk_id = %s AND status = %s
+    GROUP BY uid
+    ON CONFLICT (uid) DO UPDATE SET pending = user_balances.pending + EXCLUDED.pending
+    """, (blk_id, CREDIT_STATUS_PENDING))
+
+def change_credit_status(blk_id, status):
+    """Move the credits of blk_id to status, run before updating credits"""
+    database.execute("""
+    INSERT INTO user_balances (uid, pending, matured)
+    SELECT
+    uid,
+    SUM(CASE WHEN %(status)s = 0 THEN amount ELSE 0 END) - SUM(CASE WHEN status = 0 THEN amount ELSE 0 END),
+    SUM(CASE WHEN %(status)s = 1 THEN amount ELSE 0 END) - SUM(CASE WHEN status = 1 THEN amount ELSE 0 END)
+    FROM (
+      SELECT uid, status, COALESCE(amount_reward, 0) + COALESCE(amount_bonus, 0) + COALESCE(amount_dev, 0) AS amount
+      FROM credits
+      WHERE blk_id = %(blk_id)s AND status <> %(status)s
+    ) t
+    GROUP BY uid
+    ON CONFLICT (uid) DO UPDATE SET
+    pending = user_balances.pending + EXCLUDED.pending,
+    matured = user_balances.matured + EXCLUDED.matured
+    """, {'blk_id': blk_id, 'status': status})
+
+def add_payment(uid, amount, fee):
+    """Debit a payment just recorded"""
+    database.execute("""
+    INSERT INTO user_balances (uid, debited)
+    VALUES (%s, %s)
+    ON CONFLICT (uid) DO UPDATE SET debited = user_balances.debited + EXCLUDED.debited
+    """, (uid, (amount or 0) + (fee or 0)))
+
+def change_payment(pymt_id, status=None, amount_fee=None):
+    """Apply a payment's new status and/or fee, run before updating payments"""
+    database.execute("""
+    UPDATE user_balances SET debited = user_balances.debited + p.delta
+    FROM (
+      SELECT
+      uid,
+      CASE WHEN COALESCE(%(status)s, status) <> -1 THEN COALESCE(amount_paid, 0) + COALESCE(%(amount_fee)s, amount_fee, 0) ELSE 0 END -
+      CASE WHEN status <> -1 THEN COALESCE(amount_paid, 0) + COALESCE(amount_fee, 0) ELSE 0 END AS delta
+      FROM payments
+      WHERE pymt_id = %(pymt_id)s
+    ) AS p
+    WHERE user_balances.uid = p.uid
+    """, {'pymt_id': pymt_id, 'status': status, 'amount_fee': amount_fee})
+
+def get_payable(batch_size=1000):
+    """
+    Stream uid, wallet, threshold, pending, matured and debited for users at
+    or above their threshold, with their user_addresses wallet, valid and addr_type
+    """
+    ensure_ledger()
+    addresses.ensure_table()
+    return database.iterate("""
+    SELECT
+    users.uid,
+    users.wallet,
+    users.payment_threshold,
+    user_balances.pending,
+    user_balances.matured,
+    user_balances.debited,
+    user_addresses.wallet,
+    user_addresses.valid,
+    user_addresses.addr_type
+    FROM user_balances
+    JOIN users ON users.uid = user_balances.uid
+    LEFT JOIN user_addresses ON user_addresses.uid = users.uid
+    WHERE user_balances.matured - user_balances.debited > 0
+    AND user_balances.matured - user_balances.debited >= users.payment_threshold
+    """, batch_size=batch_size)
+
+def get_totals():
+    """Get total confirmed and pending balance owed to users"""
+    ensure_ledger()
+    database.execute('SELECT COALESCE(SUM(matured - debited), 0), COALESCE(SUM(pending), 0) FROM user_balances')
+    total_matured, total_pending = database.fetchone()
+    return int(total_matured), int(total_pending)
+
+def ensure_consolidation_fees():
+    global consolidation_fees_ready
+
+    if consolidation_fees_ready:
+        return
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS consolidation_fees (
+        txid TEXT PRIMARY KEY,
+        height BIGINT NOT NULL,
+        time BIGINT NOT NULL,
+        fee BIGINT NOT NULL
+    )
+    """)
+
+    consolidation_fees_ready = True
+
+def add_consolidation_fees(txids, fees, height, now):
+    """Record the fees of consolidation sweep txs"""
+    ensure_consolidation_fees()
+    try:
+        with database.transaction():
+            for txid, fee in zip(txids, fees):
+                database.execute("""
+                INSERT INTO consolidation_fees (txid, height, time, fee)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (txid) DO NOTHING
+                """, (txid, height, now, fee))
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+def get_consolidation_fees():
+    """Get the total fee paid by the pool for consolidation sweeps"""
+    ensure_consolidation_fees()
+    database.execute('SELECT COALESCE(SUM(fee), 0) FROM consolidation_fees')
+    return int(database.fetchone()[0])
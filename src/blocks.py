@@ -1,6 +1,6 @@
 from .constants import *
 from .errors import *
-from . import database, wallet, rpc, log
+from . import database, wallet, daemon, rpc, log
 
 def update_block_reward(blk_id, height, reward, reward_total):
     """Change a block info"""
@@ -57,46 +57,108 @@ def get_non_mature_blocks():
         log.error(e)
         raise RecoverableError('Failed to get non mature blocks') from None
 
-def unlock_blocks():
-    """Update blocks statuses"""
+def fetch_block_transfers(min_height, max_height):
+    """Get the wallet height and the block reward transfers, or None for the transfers on error"""
 
+    # read before the transfers, so a transfer the wallet has not seen yet
+    # is never judged against a later height
     wallet_height = wallet.get_wallet_height()
 
+    # Get all block transfers covering the pending blocks from wallet-rpc
+    # this shows us how much the pool received as a reward
+    try:
+        return wallet_height, wallet.get_block_transfers(min_height - 1, max_height)
+    except RecoverableError:
+        log.error('Failed to get transfers for blocks at heights %d - %d, skipping' % (min_height, max_height))
+        return wallet_height, None
+
+def fetch_block_headers(min_height, max_height):
+    """Get the block headers by height, or None on error"""
+
+    # Get the block headers from daemon-rpc, the cache is checked against
+    # the current tip first so a reorg drops any stale headers
+    # this shows us how much the total block reward was
+    try:
+        daemon.validate_header_cache()
+        return daemon.get_block_headers(min_height, max_height)
+    except RpcError:
+        log.error('Failed to get block headers for heights %d - %d, skipping' % (min_height, max_height))
+        return None
+
+def fetch_block_data(min_height, max_height):
+    """
+    Get the wallet transfers and daemon rewards for blocks from min_height
+    to max_height, without touching the database
+    """
+
+    # wallet-rpc and the daemon are asked at the same time
+    (wallet_height, transfers), headers = rpc.gather([
+        lambda: fetch_block_transfers(min_height, max_height),
+        lambda: fetch_block_headers(min_height, max_height)
+    ])
+
+    if transfers is None or headers is None:
+        return None
+
+    # (height, txid) -> amount
+    transfers_by_block = {}
+    for t in transfers:
+        transfers_by_block[(t['height'], t['txid'])] = t['amount']
+
+    # height -> reward
+    rewards_by_height = {}
+    for height, header in headers.items():
+        rewards_by_height[height] = header['reward']
+
+    return {
+        'wallet_height': wallet_height,
+        'min_height': min_height,
+        'max_height': max_height,
+        'transfers_by_block': transfers_by_block,
+        'rewards_by_height': rewards_by_height
+    }
+
+def prefetch_block_data(blocks):
+    """Fetch block data for the blocks returned by get_non_mature_blocks, or None if there are none"""
+    if not len(blocks):
+        return None
+    return fetch_block_data(min([block[1] for block in blocks]), max([block[1] for block in blocks]))
+
+def unlock_blocks(prefetched=None):
+    """Update blocks statuses, using prefetched block data if it covers them"""
+
     # Get non-matured blocks
     blocks = get_non_mature_blocks()
 
+    if not len(blocks):
+        return
+
+    min_height = min([block[1] for block in blocks])
+    max_height = max([block[1] for block in blocks])
+
+    if prefetched is not None and prefetched['min_height'] <= min_height and max_height <= prefetched['max_height']:
+        block_data = prefetched
+    else:
+        block_data = fetch_block_data(min_height, max_height)
+        if block_data is None:
+            return
+
+    wallet_height = block_data['wallet_height']
+    transfers_by_block = block_data['transfers_by_block']
+    rewards_by_height = block_data['rewards_by_height']
+
     # For each status-0 or status-1 block
     for block in blocks:
 
         blk_id, height, txid, status = block
 
-        # Get the transaction from wallet-rpc
-        # this shows us how much the pool received as a reward
-        try:
-            transfers = rpc.wallet_rpc('get_transfers', {'in': True, 'filter_by_height': True, 'min_height': height - 1, 'max_height': height})
-        except:
-            log.error('Failed to get transfers for block at height %d, skipping' % (height,))
-            continue
-
-        tx_seen = False
-        amount = 0
-
-        if 'in' in transfers:
-            for t in transfers['in']:
-                if t['height'] == height and t['type'] == 'block' and t['txid'] == txid:
-                    tx_seen = True
-                    amount = t['amount']
-                    break
-
-        # Get the transaction from daemon-rpc
-        # this shows us how much the total block reward was
-        try:
-            block_daemon = rpc.daemon_rpc('get_block', {'height': height})
-        except:
+        if height not in rewards_by_height:
             log.error('Failed to get info for block at height %d, skipping' % (height,))
             continue
 
-        amount_total = block_daemon['block_header']['reward']
+        tx_seen = (height, txid) in transfers_by_block
+        amount = transfers_by_block.get((height, txid), 0)
+        amount_total = rewards_by_height[height]
 
         # If transaction is seen
         if tx_seen:
@@ -0,0 +1,75 @@
+from time import time
+
+from .constants import *
+from .errors import *
+from . import database, balances, fee, payments, schedule, wallet, log
+
+# outputs created by a sweep are locked for 10 blocks, plus a couple of
+# blocks for the sweep to be mined
+SWEEP_UNLOCK_BLOCKS = 12
+
+last_sweep_height = None
+
+def run(height):
+    """
+    Sweep the wallet's small outputs into one while no payout is near
+
+    A sweep locks everything it spends, so it only runs when those funds
+    unlock again before the next payout, at most once per payout interval
+    and never while payout txs are waiting to be relayed or the wallet is
+    recovering.
+    """
+    global last_sweep_height
+
+    if not CONSOLIDATION_ENABLED:
+        return
+
+    if wallet.recovery_in_progress():
+        # the wallet's spent state is being rebuilt, it could sweep outputs that are already spent
+        log.message('Wallet recovery in progress, not consolidating')
+        return
+
+    blocks_left = schedule.blocks_to_next_payout(height)
+    if blocks_left <= SWEEP_UNLOCK_BLOCKS:
+        return
+
+    if last_sweep_height is not None and height - last_sweep_height < PAYMENTS_NETWORK_BLOCK_INTERVAL:
+        return
+
+    if len(payments.get_unrelayed()):
+        log.message('Payout txs are waiting to be relayed, not consolidating')
+        return
+
+    try:
+        amounts = wallet.get_unspent_amounts()
+    except RecoverableError as e:
+        # not worth failing the loop over, try again next block
+        log.error(e)
+        return
+
+    small = [amount for amount in amounts if amount < CONSOLIDATION_BELOW_AMOUNT]
+
+    log.message('Wallet has %d unlocked outputs, %d below %d totalling %d' % (
+        len(amounts), len(small), CONSOLIDATION_BELOW_AMOUNT, sum(small)))
+
+    if len(small) < CONSOLIDATION_MIN_OUTPUTS:
+        return
+
+    log.message('Consolidating %d outputs, next payout in %d blocks' % (len(small), blocks_left))
+
+    try:
+        txids, fees = wallet.sweep_all(wallet.get_address(), CONSOLIDATION_BELOW_AMOUNT)
+    except (RpcError, RecoverableError) as re:
+        log.error('Error consolidating outputs, reason: %s' % (re,))
+        return
+
+    last_sweep_height = height
+    fee.forget_unspent_outputs()
+
+    for txid, tx_fee in zip(txids, fees):
+        log.message('Consolidation tx %s, fee %d' % (txid, tx_fee))
+    log.message('Consolidated %d outputs in %d txs, total fee %d' % (len(small), len(txids), sum(fees)))
+
+    # the fees are already spent, the accounting check needs them on record
+    balances.add_consolidation_fees(txids, fees, height, database.walltime_to_db_time(time()))
+    log.message('Consolidation fee %d paid from the pool margin, %d in total' % (sum(fees), balances.get_consolidation_fees()))
@@ -1,4 +1,5 @@
 import json, sys
+from importlib.util import find_spec
 
 CREDIT_STATUS_ORPHANED = -1
 CREDIT_STATUS_PENDING = 0
@@ -26,6 +27,8 @@ with open('config.json') as json_file:
 
     BLOCK_MATURE_DEPTH = CONFIG['general']['block_mature_depth']
     BLOCK_ORPHAN_DEPTH = CONFIG['general']['block_orphan_depth']
+    HEADER_CACHE_SIZE = CONFIG['general'].get('header_cache_size', 1000)
+    STAGE_THREADS = CONFIG['general'].get('stage_threads', 4)
 
     PSQL_HOST = CONFIG['postgres']['db_hostname']
     PSQL_PORT = CONFIG['postgres']['db_port']
@@ -35,6 +38,8 @@ with open('config.json') as json_file:
 
     DAEMON_RPC_HOST = CONFIG['daemon']['hostname']
     DAEMON_RPC_PORT = CONFIG['daemon']['port']
+    DAEMON_TXS_CHUNK_SIZE = CONFIG['daemon'].get('get_transactions_chunk_size', 100)
+    DAEMON_TXS_THREADS = CONFIG['daemon'].get('get_transactions_threads', 2)
 
     WALLET_RPC_HOST = CONFIG['wallet']['hostname']
     WALLET_RPC_PORT = CONFIG['wallet']['port']
@@ -43,6 +48,11 @@ with open('config.json') as json_file:
     WALLET_RPC_USERNAME = CONFIG['wallet']['rpc_username']
     WALLET_RPC_PASSWORD = CONFIG['wallet']['rpc_password']
 
+    RPC_POOL_SIZE = CONFIG.get('rpc', {}).get('pool_size', 4)
+    RPC_CONNECT_TIMEOUT = CONFIG.get('rpc', {}).get('connect_timeout', 5)
+    RPC_DEFAULT_TIMEOUT = CONFIG.get('rpc', {}).get('default_timeout', 300)
+    RPC_TIMEOUTS = CONFIG.get('rpc', {}).get('timeouts', {})
+
     COIN_ADDRESS_PREFIXES = CONFIG['coin']['address_prefixes']
 
     PAYMENTS_PRIORITY = CONFIG['payments']['priority']
@@ -52,11 +62,39 @@ with open('config.json') as json_file:
     PAYMENTS_FEE_ADJ_FACTOR = CONFIG['payments']['fee_adjustment_factor']
     PAYMENTS_MAX_PAYMENT_AMOUNT = CONFIG['payments']['max_payment_amount']
     PAYMENTS_NETWORK_BLOCK_INTERVAL = CONFIG['payments']['network_block_interval']
+    PAYMENTS_MIN_UNLOCKED_BALANCE = CONFIG['payments'].get('min_unlocked_balance', 0)
+    PAYMENTS_PLANNER = CONFIG['payments'].get('planner', 'packed')
+    PAYMENTS_RELAY_MAX_ATTEMPTS = CONFIG['payments'].get('relay_max_attempts', 10)
+    ADDRESS_CACHE_SIZE = CONFIG['payments'].get('address_cache_size', 10000)
+
+    WALLET_RECOVERY_DEADLINE = CONFIG['wallet'].get('recovery_deadline', 3600)
+    WALLET_RECOVERY_FULL_RESCAN = CONFIG['wallet'].get('recovery_full_rescan', False)
+
+    CONSOLIDATION_ENABLED = CONFIG.get('consolidation', {}).get('enabled', False)
+    CONSOLIDATION_MIN_OUTPUTS = CONFIG.get('consolidation', {}).get('min_outputs', 30)
+    CONSOLIDATION_BELOW_AMOUNT = CONFIG.get('consolidation', {}).get('below_amount', 1000000000000)
+
+    WAKEUP_LISTEN = CONFIG.get('wakeup', {}).get('listen', True)
+    WAKEUP_TABLES = CONFIG.get('wakeup', {}).get('tables', ['mined_blocks', 'valid_shares'])
+    WAKEUP_SHARES_INTERVAL = CONFIG.get('wakeup', {}).get('shares_interval', 60)
+    WAKEUP_HEIGHT_POLL = CONFIG.get('wakeup', {}).get('wallet_height_poll', 5)
+
+    METRICS_ENABLED = CONFIG.get('metrics', {}).get('enabled', False)
+    METRICS_HOST = CONFIG.get('metrics', {}).get('host', '127.0.0.1')
+    METRICS_PORT = CONFIG.get('metrics', {}).get('port', 9478)
+
+    PPLNS_ENGINE = CONFIG.get('pplns', {}).get('engine', 'sql')
+    PPLNS_CROSS_CHECK = CONFIG.get('pplns', {}).get('cross_check', False)
 
     FEE = CONFIG['fee']['percent']
     FEE_SPLIT = CONFIG['fee']['split']
 
     LOGGING_PATH = CONFIG['logging']['path']
+    LOGGING_FORMAT = CONFIG['logging'].get('format', 'text')
+    LOGGING_MAX_SIZE = CONFIG['logging'].get('max_size', 0)
+    LOGGING_BACKUPS = CONFIG['logging'].get('backups', 5)
+    LOGGING_QUEUE_SIZE = CONFIG['logging'].get('queue_size', 10000)
+    LOGGING_RPC_PAYLOADS = CONFIG['logging'].get('rpc_payloads', {})
     LOGGING_PAYOUTD_CONSOLE = CONFIG['logging']['payoutd'] is True or CONFIG['logging']['payoutd'] == 'console' or CONFIG['logging']['payoutd'] == 'both'
     LOGGING_PAYOUTD_FILE    = CONFIG['logging']['payoutd'] is True or CONFIG['logging']['payoutd'] == 'file'    or CONFIG['logging']['payoutd'] == 'both'
     LOGGING_WALLET_CONSOLE  = CONFIG['logging']['wallet'] is True  or CONFIG['logging']['wallet'] == 'console'  or CONFIG['logging']['wallet'] == 'both'
@@ -82,6 +120,22 @@ if int(PAYOUTD_SELF_TEST_TIMEOUT) != PAYOUTD_SELF_TEST_TIMEOUT:
     print('CONFIG ERROR: Value self_test_timeout must be an integer')
     has_error = True
 
+if PPLNS_ENGINE not in ['sql', 'numpy']:
+    print('CONFIG ERROR: Value pplns engine must be "sql" or "numpy"')
+    has_error = True
+
+if PPLNS_ENGINE == 'numpy' and find_spec('numpy') is None:
+    print('CONFIG ERROR: Value pplns engine is "numpy" but numpy is not installed, run "pipenv install numpy" or use "sql"')
+    has_error = True
+
+if LOGGING_FORMAT not in ['text', 'json']:
+    print('CONFIG ERROR: Value logging format must be "text" or "json"')
+    has_error = True
+
+if PAYMENTS_PLANNER not in ['greedy', 'packed']:
+    print('CONFIG ERROR: Value payments planner must be "greedy" or "packed"')
+    has_error = True
+
 
 if has_error:
     sys.exit()
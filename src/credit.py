@@ -2,24 +2,27 @@ from math import floor
 from time import time
 
 from .constants import *
-from . import database, blocks, rpc, log
+from . import database, balances, blocks, shares, pplns, rpc, log
 
-def record_credit(blk_id, uid, now, reward, bonus_credit, dev_credit):
-    """Record calculated credit for a user"""
+def record_credits(blk_id, now, credits):
+    """Record calculated credits for a block, credits is a list of (uid, reward, bonus, dev)"""
     try:
-        database.execute('INSERT INTO credits (blk_id, uid, time, amount_reward, amount_bonus, amount_dev, status) VALUES (%s, %s, %s, %s, %s, %s, %s)',
-                         (blk_id, uid, now, reward, bonus_credit, dev_credit, CREDIT_STATUS_PENDING))
-        log.message('Credit user %d on blk %d (reward, bonus, dev): %d %d %d' % (uid, blk_id, reward or 0, bonus_credit or 0, dev_credit or 0))
+        balances.ensure_ledger()
+        with database.transaction():
+            database.execute_values('INSERT INTO credits (blk_id, uid, time, amount_reward, amount_bonus, amount_dev, status) VALUES %s',
+                                    [(blk_id, uid, now, reward, bonus_credit, dev_credit, CREDIT_STATUS_PENDING) for uid, reward, bonus_credit, dev_credit in credits])
+            balances.add_block_credits(blk_id)
+        for uid, reward, bonus_credit, dev_credit in credits:
+            log.message('Credit user %d on blk %d (reward, bonus, dev): %d %d %d' % (uid, blk_id, reward or 0, bonus_credit or 0, dev_credit or 0))
     except database.psycopg2.Error as e:
         raise Exception(e.pgerror) from None
-    except Exception as e:
-        log.error('Failed to credit user %d on blk %d (reward, bonus, dev): %d %d %d' % (uid, blk_id, reward or 0, bonus_credit or 0, dev_credit or 0))
-        log.error(e)
 
 def update_credit_status(blk_id, status):
     """Change a credit status"""
     try:
-        database.execute("UPDATE credits SET status=%s WHERE blk_id = %s", (status, blk_id))
+        with database.transaction():
+            balances.change_credit_status(blk_id, status)
+            database.execute("UPDATE credits SET status=%s WHERE blk_id = %s", (status, blk_id))
         log.message('Changed credit status on block_id %d status to %s' % (blk_id, status))
     except database.psycopg2.Error as e:
         raise Exception(e.pgerror) from None
@@ -27,7 +30,33 @@ def update_credit_status(blk_id, status):
         log.error('Failed to change credit status on block_id %d status to %s' % (blk_id, status))
         log.error(e)
 
+def cross_check(what, fast, full_scan):
+    """Compare a result against the full scan, preferring the full scan on mismatch"""
+    if fast != full_scan:
+        log.error('PPLNS engine mismatch on %s: %s != %s, using full scan' % (what, fast, full_scan))
+        return full_scan
+    return fast
+
 def get_pplns_window(timestamp, difficulty):
+    """Find the start of the PPLNS window, using the fastest source that covers timestamp"""
+
+    window = pplns.get_pplns_window(timestamp, difficulty)
+    if window is not False:
+        if PPLNS_CROSS_CHECK:
+            return cross_check('window at %d' % (timestamp,), window, get_pplns_window_full_scan(timestamp, difficulty))
+        return window
+
+    window = shares.get_pplns_window(timestamp, difficulty)
+    if window is False:
+        window = get_pplns_window_full_scan(timestamp, difficulty)
+
+    if window is not None:
+        # have the engine load enough history for this window
+        pplns.extend(window[0])
+
+    return window
+
+def get_pplns_window_full_scan(timestamp, difficulty):
 
     pplns_query = """
     SELECT time, running_total
@@ -45,6 +74,21 @@ def get_pplns_window(timestamp, difficulty):
     return database.fetchone()
 
 def get_user_shares(start_time, end_time):
+    """Get (uid, shares) in the window, using the share rollups when they cover it"""
+
+    user_shares = pplns.get_user_shares(start_time, end_time)
+    if user_shares is not False:
+        if PPLNS_CROSS_CHECK:
+            return cross_check('shares %d - %d' % (start_time, end_time), sorted(user_shares), sorted(get_user_shares_full_scan(start_time, end_time)))
+        return user_shares
+
+    user_shares = shares.get_user_shares(start_time, end_time)
+    if user_shares is not False:
+        return user_shares
+
+    return get_user_shares_full_scan(start_time, end_time)
+
+def get_user_shares_full_scan(start_time, end_time):
 
     share_query = """
     SELECT uid, sum(count)
@@ -56,6 +100,129 @@ def get_user_shares(start_time, end_time):
     database.execute(share_query, (start_time, end_time))
     return database.fetchall()
 
+def get_share_rows(start_time, end_time):
+
+    share_query = """
+    SELECT time, uid, sum(count)
+    FROM valid_shares
+    WHERE time BETWEEN %s AND %s
+    GROUP BY time, uid
+    ORDER BY time ASC
+    """
+
+    database.execute(share_query, (start_time, end_time))
+    return database.fetchall()
+
+def get_user_shares_batch(windows):
+    """
+    Get (uid, shares) for each (start_time, end_time) window in one pass
+
+    windows must be sorted by end_time. Shares covering all windows are read
+    once and a per uid accumulator slides from window to window, adding rows
+    at the head and dropping them at the tail.
+    """
+
+    rows = get_share_rows(min([window[0] for window in windows]), windows[-1][1])
+
+    # uid -> [shares, rows]
+    accumulator = {}
+
+    def add(row):
+        _, uid, count = row
+        if uid not in accumulator:
+            accumulator[uid] = [0, 0]
+        accumulator[uid][0] += int(count)
+        accumulator[uid][1] += 1
+
+    def remove(row):
+        _, uid, count = row
+        accumulator[uid][0] -= int(count)
+        accumulator[uid][1] -= 1
+        if accumulator[uid][1] == 0:
+            accumulator.pop(uid)
+
+    # rows[tail:head] are the rows inside the current window
+    head = 0
+    tail = 0
+
+    result = []
+    for start_time, end_time in windows:
+        while head < len(rows) and rows[head][0] <= end_time:
+            add(rows[head])
+            head += 1
+        while tail < head and rows[tail][0] < start_time:
+            remove(rows[tail])
+            tail += 1
+        # a higher difficulty block can start earlier than the previous one
+        while tail > 0 and rows[tail - 1][0] >= start_time:
+            tail -= 1
+            add(rows[tail])
+
+        result.append([(uid, shares_rows[0]) for uid, shares_rows in accumulator.items()])
+
+    return result
+
+def credit_block(block, user_shares, now):
+    """Split a block reward among user_shares and record the credits"""
+
+    blk_id = block['blk_id']
+    height = block['height']
+    reward = int(block['reward'] * ((100 - FEE) / 100))
+
+    total_credited = 0
+
+    total_shares = sum([user_share[1] for user_share in user_shares])
+
+    log.message('Block %d will credit %d miners (total shares %d)' % (height, len(user_shares), total_shares))
+
+    credits_per_uid = {}
+
+    # credit users
+    for user_share in user_shares:
+        uid, user_shares = user_share
+        user_pct = min(1, user_shares / total_shares)
+        # integer maths so every share source gives identical credits
+        user_reward = min(reward, int(user_shares) * reward // int(total_shares))
+
+        total_credited += user_reward
+
+        if uid not in credits_per_uid:
+            credits_per_uid[uid] = {}
+
+        # Credit reward
+        log.message('User %d submitted %d shares for %f%% of the block' % (uid, user_shares, user_pct))
+        credits_per_uid[uid]['reward'] = user_reward
+
+
+    # Credit devs
+    total_dev_fee = block['reward'] - total_credited
+    log.message('Total credits for block %s is %s leaving %d for devfee' % (height, total_credited, total_dev_fee))
+
+    for dev in FEE_SPLIT:
+        dev_uid = dev['uid']
+        dev_fee_amount = floor(total_dev_fee * dev['percent'] / 100)
+        log.message('Credit %s dev fee to %s' % (dev_fee_amount, dev['name']))
+
+        if dev_uid not in credits_per_uid:
+            credits_per_uid[dev_uid] = {}
+
+        credits_per_uid[dev_uid]['dev'] = dev_fee_amount
+
+
+    credits = []
+    for uid in credits_per_uid:
+        reward = credits_per_uid[uid].get('reward')
+        bonus_credit = credits_per_uid[uid].get('bonus')
+        dev_credit = credits_per_uid[uid].get('dev')
+
+        credits.append((uid, reward, bonus_credit, dev_credit))
+
+    # Add credits to db and mark as credited together, so a block is
+    # either fully credited or not at all
+    with database.transaction():
+        record_credits(blk_id, now, credits)
+        blocks.update_block_status(blk_id, height, BLOCK_STATUS_CREDITED)
+
 def calculate():
 
     now = database.walltime_to_db_time(time())
@@ -63,20 +230,25 @@ def calculate():
     # Get uncredited blocks
     unpaid_blocks = blocks.get_blocks_by_status(BLOCK_STATUS_TX_SEEN)
 
-    for block in unpaid_blocks:
+    shares.update_rollups(now)
+    pplns.update(now)
+
+    if len(unpaid_blocks):
+        shares.update_index(now)
+
+    # blocks and their (start_time, end_time) PPLNS windows, oldest first
+    pending = []
+
+    for block in sorted(unpaid_blocks, key=lambda k: k['time']):
 
         if block['reward'] is None:
             log.message('Block %d at height %d does not have reward set, skipping' % (block['blk_id'], block['height']))
             continue
 
-        blk_id = block['blk_id']
         height = block['height']
-        reward = int(block['reward'] * ((100 - FEE) / 100))
         end_time = block['time']
         difficulty = block['difficulty']
 
-        total_credited = 0
-
         log.message('Calculating credits for block %d' % (height))
 
         pplns_window = get_pplns_window(end_time, 2 * difficulty)
@@ -91,56 +263,23 @@ def calculate():
 
         log.message('Block %d has PPLNS window of %d seconds (diff %d)' % (height, n_seconds, difficulty))
 
-        user_shares = get_user_shares(start_time, end_time)
-
-        total_shares = sum([user_share[1] for user_share in user_shares])
-
-        log.message('Block %d will credit %d miners (total shares %d)' % (height, len(user_shares), total_shares))
-
-        credits_per_uid = {}
-
-        # credit users
-        for user_share in user_shares:
-            uid, user_shares = user_share
-            user_pct = min(1, user_shares / total_shares)
-            user_reward = int(user_pct * reward)
-
-            total_credited += user_reward
+        pending.append((block, (start_time, end_time)))
 
-            if uid not in credits_per_uid:
-                credits_per_uid[uid] = {}
+    if not len(pending):
+        return
 
-            # Credit reward
-            log.message('User %d submitted %d shares for %f%% of the block' % (uid, user_shares, user_pct))
-            credits_per_uid[uid]['reward'] = user_reward
+    if len(pending) == 1 or pplns.enabled():
+        for block, (start_time, end_time) in pending:
+            credit_block(block, get_user_shares(start_time, end_time), now)
+        return
 
+    # Several blocks to catch up on, sweep their windows in a single pass
+    log.message('Calculating credits for %d blocks in one pass' % (len(pending),))
 
-        # Credit devs
-        total_dev_fee = block['reward'] - total_credited
-        log.message('Total credits for block %s is %s leaving %d for devfee' % (height, total_credited, total_dev_fee))
+    user_shares_per_block = get_user_shares_batch([window for _, window in pending])
 
-        for dev in FEE_SPLIT:
-            dev_uid = dev['uid']
-            dev_fee_amount = floor(total_dev_fee * dev['percent'] / 100)
-            log.message('Credit %s dev fee to %s' % (dev_fee_amount, dev['name']))
-
-            if dev_uid not in credits_per_uid:
-                credits_per_uid[dev_uid] = {}
-
-            credits_per_uid[dev_uid]['dev'] = dev_fee_amount
-
-
-        # Add credits to db
-        for uid in credits_per_uid:
-            reward = credits_per_uid[uid].get('reward')
-            bonus_credit = credits_per_uid[uid].get('bonus')
-            dev_credit = credits_per_uid[uid].get('dev')
-
-            record_credit(blk_id, uid, now, reward, bonus_credit, dev_credit)
-
-
-        # mark as credited
-        blocks.update_block_status(blk_id, height, BLOCK_STATUS_CREDITED)
+    for (block, _), user_shares in zip(pending, user_shares_per_block):
+        credit_block(block, user_shares, now)
 
 
 def unlock():
@@ -149,10 +288,11 @@ def unlock():
     for block in matured_blocks:
         blk_id = block['blk_id']
         height = block['height']
-        # update credit status
-        update_credit_status(blk_id, CREDIT_STATUS_MATURED)
-        # mark as closed
-        blocks.update_block_status(blk_id, height, BLOCK_STATUS_CLOSED)
+        with database.transaction():
+            # update credit status
+            update_credit_status(blk_id, CREDIT_STATUS_MATURED)
+            # mark as closed
+            blocks.update_block_status(blk_id, height, BLOCK_STATUS_CLOSED)
 
     orphaned_blocks = blocks.get_blocks_by_status(BLOCK_STATUS_ORPHANED)
     for block in orphaned_blocks:
@@ -1,18 +1,207 @@
-from . import rpc
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from .constants import *
+from . import rpc, log
+
+# restricted daemons refuse header ranges larger than this
+HEADERS_RANGE_LIMIT = 1000
+
+# tx serialization tags
+TXIN_GEN = 0xff
+TXIN_TO_KEY = 0x02
+TXOUT_TO_KEY = 0x02
+TXOUT_TO_TAGGED_KEY = 0x03
+
+# number of headers fetched per step when walking back to a fork point
+REORG_SEARCH_STEP = 16
+
+# height -> { height, hash, prev_hash, reward }
+header_cache = {}
+header_cache_tip = None
+header_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+def cache_header(header):
+    header_cache[header['height']] = {
+        'height': header['height'],
+        'hash': header['hash'],
+        'prev_hash': header['prev_hash'],
+        'reward': header['reward']
+    }
+
+    # keep the most recent heights, those are the ones still being checked
+    while len(header_cache) > HEADER_CACHE_SIZE:
+        header_cache.pop(min(header_cache))
+
+def invalidate_header_cache(fork_height):
+    """Drop cached headers at or above fork_height"""
+    heights = [height for height in header_cache if height >= fork_height]
+    for height in heights:
+        header_cache.pop(height)
+    header_cache_stats['invalidations'] += len(heights)
+    return len(heights)
+
+def find_fork_height(height):
+    """Walk down from height until the daemon agrees with the cache"""
+    lowest = min(header_cache)
+    while height >= lowest:
+        start_height = max(lowest, height - REORG_SEARCH_STEP + 1)
+        headers = get_block_headers_range(start_height, height)
+        for header in reversed(headers):
+            cached = header_cache.get(header['height'])
+            if cached is not None and cached['hash'] == header['hash']:
+                return header['height'] + 1
+        height = start_height - 1
+    return lowest
+
+def validate_header_cache():
+    """Compare the cached chain against the daemon tip, dropping anything past a fork"""
+    global header_cache_tip
+
+    tip = rpc.daemon_rpc('get_last_block_header')['block_header']
+
+    if header_cache_tip is not None and len(header_cache):
+        tip_height, tip_hash = header_cache_tip
+
+        if tip['height'] == tip_height and tip['hash'] == tip_hash:
+            # nothing changed
+            pass
+        elif tip['height'] == tip_height + 1 and tip['prev_hash'] == tip_hash:
+            # chain was extended by one block
+            pass
+        else:
+            # chain moved by more than one block, or was replaced
+            fork_height = find_fork_height(min(tip_height, tip['height']))
+            n_dropped = invalidate_header_cache(fork_height)
+            if n_dropped:
+                log.message('Chain reorganisation at height %d, dropped %d cached headers' % (fork_height, n_dropped))
+
+    header_cache_tip = (tip['height'], tip['hash'])
+    return tip['height']
+
+def get_block_headers(start_height, end_height):
+    """Get block headers from start_height to end_height inclusive, using the cache"""
+    missing = [height for height in range(start_height, end_height + 1) if height not in header_cache]
+
+    header_cache_stats['hits'] += end_height + 1 - start_height - len(missing)
+    header_cache_stats['misses'] += len(missing)
+
+    if len(missing):
+        for header in get_block_headers_range(min(missing), max(missing)):
+            cache_header(header)
+
+    return { height: header_cache[height] for height in range(start_height, end_height + 1) if height in header_cache }
+
+def get_block_header(height):
+    """Get a single block header, using the cache"""
+    return get_block_headers(height, height).get(height)
+
+def log_stats():
+    log.message('Header cache: %d cached, %d hits, %d misses, %d invalidated' % (
+        len(header_cache), header_cache_stats['hits'], header_cache_stats['misses'], header_cache_stats['invalidations']))
 
 def get_block(height):
     """Get the block from daemon"""
-    return rpc.daemon_rpc('get_block', {'height': height})
+    block = rpc.daemon_rpc('get_block', {'height': height})
+    cache_header(block['block_header'])
+    return block
+
+def get_block_headers_range(start_height, end_height):
+    """Get block headers from start_height to end_height inclusive"""
+    headers = []
+    for chunk_start in range(start_height, end_height + 1, HEADERS_RANGE_LIMIT):
+        chunk_end = min(end_height, chunk_start + HEADERS_RANGE_LIMIT - 1)
+        result = rpc.daemon_rpc('get_block_headers_range', {'start_height': chunk_start, 'end_height': chunk_end})
+        headers += result.get('headers', [])
+    return headers
 
 def get_fee_estimate():
     """Get the fee estimate from daemon"""
     return rpc.daemon_rpc('get_fee_estimate')
 
 def get_transactions(txids):
-    """Get tx details from daemon"""
+    """Get pruned tx details from daemon for a single chunk of txids"""
     parameters = {
         'txs_hashes': txids,
-        'decode_as_json': True
+        'decode_as_json': False,
+        'prune': True
     }
     result = rpc.daemon_rpc_other('get_transactions', parameters)
     return result.get('txs', [])
+
+def iter_transactions(txids):
+    """
+    Yield pruned tx details for txids
+
+    Requests are split in chunks small enough for restricted daemons and
+    run a few at a time, at most that many chunk responses are held in
+    memory at once.
+    """
+    chunks = [txids[i:i + DAEMON_TXS_CHUNK_SIZE] for i in range(0, len(txids), DAEMON_TXS_CHUNK_SIZE)]
+
+    with ThreadPoolExecutor(max_workers=DAEMON_TXS_THREADS) as executor:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(get_transactions, chunk))
+            if len(in_flight) >= DAEMON_TXS_THREADS:
+                for transaction in in_flight.popleft().result():
+                    yield transaction
+        while len(in_flight):
+            for transaction in in_flight.popleft().result():
+                yield transaction
+
+def read_varint(blob, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = blob[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+def parse_tx_prefix(blob):
+    """Read the input key images and output public keys from the prefix of a tx blob"""
+    # version, unlock_time
+    _, pos = read_varint(blob, 0)
+    _, pos = read_varint(blob, pos)
+
+    key_images = []
+    n_inputs, pos = read_varint(blob, pos)
+    for _ in range(n_inputs):
+        tag = blob[pos]
+        pos += 1
+        if tag == TXIN_GEN:
+            _, pos = read_varint(blob, pos)
+        elif tag == TXIN_TO_KEY:
+            # amount, key offsets, key image
+            _, pos = read_varint(blob, pos)
+            n_offsets, pos = read_varint(blob, pos)
+            for _ in range(n_offsets):
+                _, pos = read_varint(blob, pos)
+            key_images.append(blob[pos:pos + 32].hex())
+            pos += 32
+        else:
+            raise ValueError('Unknown tx input type %d' % (tag,))
+
+    keys = []
+    n_outputs, pos = read_varint(blob, pos)
+    for _ in range(n_outputs):
+        _, pos = read_varint(blob, pos)
+        tag = blob[pos]
+        pos += 1
+        if tag == TXOUT_TO_KEY:
+            keys.append(blob[pos:pos + 32].hex())
+            pos += 32
+        elif tag == TXOUT_TO_TAGGED_KEY:
+            keys.append(blob[pos:pos + 32].hex())
+            pos += 33
+        else:
+            raise ValueError('Unknown tx output type %d' % (tag,))
+
+    return key_images, keys
+
+def get_output_keys(transaction):
+    """Read the output public keys from the prefix of a pruned tx blob"""
+    return parse_tx_prefix(bytes.fromhex(transaction['pruned_as_hex']))[1]
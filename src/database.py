@@ -1,13 +1,21 @@
 from math import floor
+from contextlib import contextmanager
+import time
+import threading
 
 import psycopg2
+import psycopg2.extras
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from .constants import *
-from . import log
+from . import metrics, log
 
 conn = None
 cur = None
+transaction_depth = 0
+
+# held by whoever is using conn/cur when more than one thread is running
+lock = threading.RLock()
 
 def db_time_to_walltime(db_time):
     return floor(db_time + 1262304000)
@@ -18,7 +26,9 @@ def walltime_to_db_time(walltime):
 def connection_init():
     """Create database connection"""
 
-    global conn, cur
+    global conn, cur, transaction_depth
+
+    transaction_depth = 0
 
     try:
         conn = psycopg2.connect(user=PSQL_USERNAME,
@@ -51,8 +61,65 @@ def check_connection():
 def get_connection():
     return conn, cur
 
+def is_write(query):
+    return query.lstrip().split(None, 1)[0].upper() in ('INSERT', 'UPDATE', 'DELETE')
+
 def execute(query, parameters=None):
-    return cur.execute(query, parameters)
+    if not METRICS_ENABLED:
+        return cur.execute(query, parameters)
+
+    start = time.time()
+    try:
+        return cur.execute(query, parameters)
+    finally:
+        metrics.observe_query(metrics.call_site(1), query, time.time() - start, cur.rowcount if is_write(query) else 0)
+
+def execute_values(query, rows, page_size=1000):
+    """Run a multi-row VALUES %s query"""
+    if not METRICS_ENABLED:
+        return psycopg2.extras.execute_values(cur, query, rows, page_size=page_size)
+
+    start = time.time()
+    try:
+        return psycopg2.extras.execute_values(cur, query, rows, page_size=page_size)
+    finally:
+        metrics.observe_query(metrics.call_site(1), query, time.time() - start, len(rows))
+
+@contextmanager
+def transaction():
+    """Run the enclosed statements in a single transaction, nested calls join the outer one"""
+    global transaction_depth
+
+    if transaction_depth:
+        transaction_depth += 1
+        try:
+            yield
+        finally:
+            transaction_depth -= 1
+        return
+
+    execute('BEGIN')
+    transaction_depth = 1
+    try:
+        yield
+    except:
+        transaction_depth = 0
+        execute('ROLLBACK')
+        raise
+    transaction_depth = 0
+    execute('COMMIT')
+
+def iterate(query, parameters=None, batch_size=1000):
+    """Stream rows of query through a server side cursor, batch_size rows at a time"""
+    # WITH HOLD lets the cursor live outside a transaction on an autocommit connection
+    named_cur = conn.cursor(name='payoutd_stream', withhold=True)
+    named_cur.itersize = batch_size
+    try:
+        named_cur.execute(query, parameters)
+        for row in named_cur:
+            yield row
+    finally:
+        named_cur.close()
 
 def fetchone():
     return cur.fetchone()
@@ -0,0 +1,185 @@
+import os, re, time, select
+from collections import deque
+
+from .constants import *
+from .errors import *
+from . import database, rpc, wallet, log
+
+# The main loop sleeps in wait(), which returns as soon as something worth
+# a new cycle happens: a Postgres notification from one of the watched
+# tables, a new wallet height, or a signal. Everything is multiplexed on
+# one select() call, signals get in through a self-pipe so the handlers
+# never take a lock.
+
+NOTIFY_CHANNEL = 'payoutd_wakeup'
+
+# wakeup reasons posted by signal handlers, deque appends are atomic
+posted = deque()
+
+pipe_r, pipe_w = os.pipe()
+os.set_blocking(pipe_r, False)
+os.set_blocking(pipe_w, False)
+
+listen_conn = None
+listen_retry_at = 0
+
+# last wallet height the main loop has processed
+known_height = None
+last_share_wakeup = 0
+
+def post(reason):
+    """Wake wait() up, safe to call from a signal handler"""
+    posted.append(reason)
+    try:
+        os.write(pipe_w, b'x')
+    except BlockingIOError:
+        # the pipe is full, wait() is already going to wake up
+        pass
+
+def set_known_height(height):
+    global known_height
+    known_height = height
+
+def install_triggers():
+    """Make the watched tables notify NOTIFY_CHANNEL on every insert or update"""
+    try:
+        with database.transaction():
+            database.execute("""
+            CREATE OR REPLACE FUNCTION payoutd_notify() RETURNS trigger AS $$
+            BEGIN
+              PERFORM pg_notify('""" + NOTIFY_CHANNEL + """', TG_TABLE_NAME);
+              RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+            """)
+            for table in WAKEUP_TABLES:
+                if not re.match(r'^[a-z_][a-z0-9_]*$', table):
+                    raise Exception('Invalid table name %s' % (table,))
+                database.execute('DROP TRIGGER IF EXISTS payoutd_notify ON ' + table)
+                database.execute('CREATE TRIGGER payoutd_notify AFTER INSERT OR UPDATE ON ' + table +
+                                 ' FOR EACH STATEMENT EXECUTE PROCEDURE payoutd_notify()')
+        return True
+    except Exception as e:
+        log.error('Failed to install wakeup triggers, falling back to the interval timer')
+        log.error(e)
+        return False
+
+def connect_listener():
+    """Open the connection that LISTENs for table changes"""
+    global listen_conn, listen_retry_at
+
+    if not WAKEUP_LISTEN or listen_conn is not None or time.time() < listen_retry_at:
+        return
+
+    try:
+        conn = database.psycopg2.connect(user=PSQL_USERNAME,
+                                         password=PSQL_PASSWORD,
+                                         dbname=PSQL_NAME,
+                                         host=PSQL_HOST,
+                                         port=PSQL_PORT)
+        conn.set_isolation_level(database.ISOLATION_LEVEL_AUTOCOMMIT)
+        conn.cursor().execute('LISTEN ' + NOTIFY_CHANNEL)
+        listen_conn = conn
+        log.message('Listening for changes to %s' % (', '.join(WAKEUP_TABLES),))
+    except database.psycopg2.Error as e:
+        log.error('Failed to LISTEN for table changes, retrying in %d seconds' % (PAYOUTD_TIMEOUT,))
+        log.error(e)
+        listen_retry_at = time.time() + PAYOUTD_TIMEOUT
+
+def close_listener():
+    global listen_conn
+    if listen_conn is not None:
+        try:
+            listen_conn.close()
+        except database.psycopg2.Error:
+            pass
+        listen_conn = None
+
+def own_backend_pid():
+    """Backend pid of the main connection, whose own writes are not worth waking up for"""
+    try:
+        return database.conn.get_backend_pid() if database.conn is not None else None
+    except database.psycopg2.Error:
+        return None
+
+def read_notifications():
+    """Get the reasons to wake up from pending notifications, the names of the changed tables"""
+    global last_share_wakeup, listen_retry_at
+
+    reasons = []
+    try:
+        listen_conn.poll()
+    except database.psycopg2.Error as e:
+        log.error('Lost the LISTEN connection')
+        log.error(e)
+        close_listener()
+        listen_retry_at = time.time() + PAYOUTD_TIMEOUT
+        return reasons
+
+    own_pid = own_backend_pid()
+
+    while listen_conn.notifies:
+        notify = listen_conn.notifies.pop(0)
+        if notify.pid == own_pid:
+            # i.e. update_block_status, already handled by the cycle that wrote it
+            continue
+        table = notify.payload
+        if table == 'valid_shares':
+            # shares arrive all the time, they only need the credits recalculated now and then
+            if time.time() - last_share_wakeup < WAKEUP_SHARES_INTERVAL:
+                continue
+            last_share_wakeup = time.time()
+        reasons.append(table)
+
+    return reasons
+
+def check_height():
+    """Get a wakeup reason if the wallet moved past the last processed height"""
+    if known_height is None or wallet.recovery_in_progress():
+        return []
+    try:
+        height = rpc.wallet_rpc('get_height')['height']
+    except RpcError:
+        return []
+    if height != known_height:
+        return ['height %d' % (height,)]
+    return []
+
+def wait(timeout, watch_height=True):
+    """Wait up to timeout seconds, returns the wakeup reasons or [] if the time ran out"""
+    deadline = time.time() + timeout
+    next_height_check = time.time() + WAKEUP_HEIGHT_POLL if watch_height and WAKEUP_HEIGHT_POLL > 0 else float('inf')
+
+    connect_listener()
+
+    while True:
+        now = time.time()
+        if now >= deadline:
+            return []
+
+        readers = [pipe_r]
+        if listen_conn is not None:
+            readers.append(listen_conn)
+
+        ready, _, _ = select.select(readers, [], [], max(0, min(deadline, next_height_check) - now))
+
+        reasons = []
+
+        if pipe_r in ready:
+            try:
+                while os.read(pipe_r, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        while len(posted):
+            reasons.append(posted.popleft())
+
+        if listen_conn is not None and listen_conn in ready:
+            reasons += read_notifications()
+
+        if time.time() >= next_height_check:
+            reasons += check_height()
+            next_height_check = time.time() + WAKEUP_HEIGHT_POLL
+
+        if len(reasons):
+            return reasons
@@ -1,62 +1,179 @@
 from math import floor, ceil
 
 from .constants import *
-from . import daemon, log
+from .errors import *
+from . import daemon, wallet, log
+
+# wallet2 prefers at least this many inputs per tx when it has them
+MIN_INPUTS = 2
+
+# (height, fee_per_b, quantization_mask) of the last daemon fee estimate
+fee_estimate_cache = None
+
+# chain height the current payout is built at, set by set_height
+fee_height = None
+
+# amounts of the unlocked, unfrozen outputs in the wallet, largest first
+unspent_outputs = None
+
+# (estimated, actual) fee of every tx built since the last report
+fee_history = []
 
 def split_fee(fee, n):
     return floor(fee / n)
 
 def estimate_fee(recipients):
+    """Estimate the fee wallet-rpc will charge for a tx paying recipients"""
 
-    extra = 0
+    n_outputs = len(recipients) + 1
 
-    # for recipient in recipients:
-    #     # if sub address, add N bytes
-    #     if 'payment_id' in recipient:
-    #         extra += 32
+    fee_per_b, quantization_mask = get_fee_per_b()
 
+    # the fee itself has to come out of the inputs too, so grow the input
+    # count until the inputs cover the fee at that weight
+    amount = sum([recipient['amount'] for recipient in recipients])
+    n_inputs = predict_inputs(amount)
+    while True:
+        weight = estimate_tx_weight(n_inputs, PAYMENTS_RING_SIZE - 1, n_outputs, estimate_extra_size(recipients))
+        fee = int(ceil(fee_per_b * weight / quantization_mask) * quantization_mask)
+        n_needed = predict_inputs(amount + fee)
+        if n_needed <= n_inputs:
+            return fee
+        n_inputs = n_needed
 
-    bytes_no = estimate_rct_tx_size(n_inputs=4, mixin=PAYMENTS_RING_SIZE - 1, n_outputs=len(recipients) + 1, extra_size=extra, bulletproof=True)
+def set_height(height):
+    """Set the height fee estimates are cached for, the height of the payout being built"""
+    global fee_height
+    fee_height = height
 
-    fee_multiplier = get_fee_multiplier(PAYMENTS_PRIORITY)
+def get_fee_per_b():
+    """Get the per byte fee for PAYMENTS_PRIORITY, asking the daemon at most once per height"""
+    global fee_estimate_cache
 
-    fee_per_b = fee_per_b_default()
+    height = fee_height
+
+    if height is not None and fee_estimate_cache is not None and fee_estimate_cache[0] == height:
+        return fee_estimate_cache[1:]
+
+    fee_per_b = fee_per_b_default() * get_fee_multiplier(PAYMENTS_PRIORITY)
     quantization_mask = fee_quantization_mask_default()
 
     try:
         result = daemon.get_fee_estimate()
-        fee_per_b = result['fee']
         quantization_mask = result['quantization_mask']
+        if 'fees' in result:
+            # one per byte fee for each priority, multipliers included
+            fee_per_b = result['fees'][get_priority_index(PAYMENTS_PRIORITY, len(result['fees']))]
+        else:
+            fee_per_b = result['fee'] * get_fee_multiplier(PAYMENTS_PRIORITY)
     except:
         log.error('Failed to get_fee_estimate from daemon')
+        return fee_per_b, quantization_mask
+
+    if height is not None:
+        fee_estimate_cache = (height, fee_per_b, quantization_mask)
+
+    return fee_per_b, quantization_mask
+
+def get_unspent_outputs():
+    """Get the amounts the wallet can spend right now, largest first"""
+    global unspent_outputs
+
+    if unspent_outputs is None:
+        try:
+            unspent_outputs = sorted(wallet.get_unspent_amounts(), reverse=True)
+        except RecoverableError:
+            log.error('Failed to get unspent outputs from wallet, assuming %d inputs per tx' % (MIN_INPUTS,))
+            return None
+
+    return unspent_outputs
+
+def forget_unspent_outputs():
+    """Drop the cached outputs, call after the wallet spends or freezes any"""
+    global unspent_outputs
+    unspent_outputs = None
+
+def predict_inputs(amount):
+    """Number of inputs needed to cover amount, taking the largest outputs first"""
+    outputs = get_unspent_outputs()
+
+    if outputs is None:
+        return MIN_INPUTS
+
+    total = 0
+    n_inputs = 0
+    for output in outputs:
+        if total >= amount:
+            break
+        total += output
+        n_inputs += 1
+
+    return max(n_inputs, min(MIN_INPUTS, len(outputs)), 1)
+
+def estimate_extra_size(recipients):
+    """Size of tx_extra wallet2 will produce for recipients"""
+
+    # tx public key
+    size = 1 + 32
 
-    fee = int(ceil(fee_per_b * bytes_no / quantization_mask) * quantization_mask)
+    n_subaddresses = len([recipient for recipient in recipients if recipient.get('addr_type') == 'subaddress'])
+    n_integrated = len([recipient for recipient in recipients if recipient.get('addr_type') == 'integrated'])
 
-    return fee
+    if n_integrated or len(recipients) == 1:
+        # encrypted payment id, a dummy one for single recipient txs
+        size += 1 + 1 + 1 + 8
+
+    if n_subaddresses and len(recipients) > 1:
+        # one additional tx public key per output
+        size += 1 + 1 + 32 * (len(recipients) + 1)
+
+    return size
+
+def record_fee(estimated, actual):
+    fee_history.append((estimated, actual))
+
+def log_stats():
+    """Print estimated against actual fee for the txs built since the last call"""
+    if not len(fee_history):
+        return
+
+    for estimated, actual in fee_history:
+        log.message('Fee estimated %d, actual %d, ratio %.3f' % (estimated, actual, actual / estimated if estimated else 0))
+
+    ratios = [actual / estimated for estimated, actual in fee_history if estimated]
+    if len(ratios):
+        log.message('Fee estimate over %d txs: mean actual/estimated %.3f, max %.3f, fee_adjustment_factor is %s' % (
+            len(ratios), sum(ratios) / len(ratios), max(ratios), PAYMENTS_FEE_ADJ_FACTOR))
+
+    del fee_history[:]
 
 def default_priority():
     return 1
 
 def fee_per_b_default():
-    return 2000000000
+    return 20000
 
 def fee_quantization_mask_default():
     return 10000
 
-def get_fee_multiplier(priority):
-    multipliers = [1, 5, 25, 1000]
+def get_priority_index(priority, n_priorities):
     if priority <= 0:
         priority = default_priority()
 
-    priority -= 1
+    return min(priority, n_priorities) - 1
 
-    if priority >= len(multipliers):
-        priority = len(multipliers) - 1
-
-    return multipliers[priority]
+def get_fee_multiplier(priority):
+    multipliers = [1, 5, 25, 1000]
+    return multipliers[get_priority_index(priority, len(multipliers))]
 
+def get_log_padded_outputs(n_outputs, minimum=0):
+    log_padded_outputs = minimum
+    while (1 << log_padded_outputs) < n_outputs:
+        log_padded_outputs += 1
+    return log_padded_outputs
 
-def estimate_rct_tx_size(n_inputs, mixin, n_outputs, extra_size, bulletproof):
+def estimate_rct_tx_size(n_inputs, mixin, n_outputs, extra_size, bulletproof=True, clsag=True, bulletproof_plus=True, view_tags=True):
+    """Serialized tx size, as wallet2 estimates it"""
     size = 0
 
     #  tx prefix
@@ -70,6 +187,10 @@ def estimate_rct_tx_size(n_inputs, mixin, n_outputs, extra_size, bulletproof):
     # vout
     size += n_outputs * (6 + 32)
 
+    # view tags
+    if view_tags:
+        size += n_outputs
+
     # extra
     size += extra_size
 
@@ -79,29 +200,42 @@ def estimate_rct_tx_size(n_inputs, mixin, n_outputs, extra_size, bulletproof):
     size += 1
 
     # rangeSigs
-    if bulletproof:
-        size += ((2 * 6 + 4 + 5) * 32 + 3) * n_outputs
-
-        # log_padded_outputs = 0
-        # while (1<<log_padded_outputs) < n_outputs:
-        #     ++log_padded_outputs
-        # size += (2 * (6 + log_padded_outputs) + 4 + 5) * 32 + 3
+    if bulletproof or bulletproof_plus:
+        log_padded_outputs = get_log_padded_outputs(n_outputs)
+        size += (2 * (6 + log_padded_outputs) + (6 if bulletproof_plus else 4 + 5)) * 32 + 3
     else:
         size += (2 * 64 * 32 + 32 + 64 * 32) * n_outputs
 
-    # MGs
-    size += n_inputs * (64 * (mixin + 1) + 32)
+    # CLSAGs or MGs
+    if clsag:
+        size += n_inputs * (32 * (mixin + 1) + 64)
+    else:
+        size += n_inputs * (64 * (mixin + 1) + 32)
 
     # mixRing - not serialized, can be reconstructed
     # size += 2 * 32 * (mixin+1) * n_inputs
 
     # pseudoOuts
     size += 32 * n_inputs
-    # ecdhInfo
-    size += 2 * 32 * n_outputs
+    # ecdhInfo, only the 8 byte amount is saved
+    size += 8 * n_outputs
     # outPk - only commitment is saved
     size += 32 * n_outputs
     # txnFee
     size += 4
 
     return size
+
+def estimate_tx_weight(n_inputs, mixin, n_outputs, extra_size, bulletproof=True, clsag=True, bulletproof_plus=True, view_tags=True):
+    """Tx weight, the size plus the bulletproof clawback for txs with more than 2 outputs"""
+    size = estimate_rct_tx_size(n_inputs, mixin, n_outputs, extra_size, bulletproof, clsag, bulletproof_plus, view_tags)
+
+    if (bulletproof or bulletproof_plus) and n_outputs > 2:
+        n_base = 6 if bulletproof_plus else 9
+        # notional size of a 2 output proof, per output
+        bp_base = (32 * (n_base + 7 * 2)) // 2
+        log_padded_outputs = get_log_padded_outputs(n_outputs, 2)
+        bp_size = 32 * (n_base + 2 * (6 + log_padded_outputs))
+        size += (bp_base * (1 << log_padded_outputs) - bp_size) * 4 // 5
+
+    return size
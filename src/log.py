@@ -1,96 +1,222 @@
-import datetime, time, os
+import datetime, time, os, json, gzip, shutil, threading, queue, atexit
 from colorama import init as colorama_init, Fore
 
 from .constants import *
 
 colorama_init(autoreset=True)
 
-PAYOUTD_LOG_FILE = False
-WALLET_LOG_FILE = False
-DAEMON_LOG_FILE = False
+# Records are queued by the callers and written by a single background
+# thread, which flushes the files once per batch. Use flush() where a
+# record must be on disk before going on.
 
-def open_log_files():
-    global PAYOUTD_LOG_FILE, WALLET_LOG_FILE, DAEMON_LOG_FILE
-    if LOGGING_PAYOUTD_FILE:
-        PAYOUTD_LOG_FILE = open(os.path.join(LOGGING_PATH, 'payoutd.log'), 'a+')
-    if LOGGING_WALLET_FILE:
-        WALLET_LOG_FILE = open(os.path.join(LOGGING_PATH, 'wallet.log'), 'a+')
-    if LOGGING_DAEMON_FILE:
-        DAEMON_LOG_FILE = open(os.path.join(LOGGING_PATH, 'daemon.log'), 'a+')
+# most records written before the files are flushed
+BATCH_SIZE = 500
+
+# channel -> (console, file, file name)
+CHANNELS = {
+    'payoutd': (LOGGING_PAYOUTD_CONSOLE, LOGGING_PAYOUTD_FILE, 'payoutd.log'),
+    'wallet': (LOGGING_WALLET_CONSOLE, LOGGING_WALLET_FILE, 'wallet.log'),
+    'daemon': (LOGGING_DAEMON_CONSOLE, LOGGING_DAEMON_FILE, 'daemon.log'),
+}
+
+# channel -> open file, only touched by the writer thread
+files = {}
 
-open_log_files()
+# channel -> number of rpc responses seen, for sampling
+rpc_responses = {'wallet': 0, 'daemon': 0}
 
-def ts():
-    return datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
+records = queue.Queue(maxsize=LOGGING_QUEUE_SIZE)
+
+# rpc payload records dropped because the queue was full
+dropped = 0
+dropped_lock = threading.Lock()
+
+def open_log_files():
+    """Reopen the log files, i.e. after logrotate moved them"""
+    records.put(('reopen', None))
+
+def flush():
+    """Block until every record queued so far is written and synced to disk"""
+    if not writer_thread.is_alive():
+        return
+    done = threading.Event()
+    records.put(('flush', done))
+    done.wait()
+
+def ts(timestamp=None):
+    return datetime.datetime.fromtimestamp(timestamp or time.time()).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def enqueue(channel, level, msg, color=None, droppable=False):
+    global dropped
+    record = (channel, level, time.time(), msg, color)
+    if droppable:
+        # rpc payloads are not worth stalling the caller for
+        try:
+            records.put_nowait(('record', record))
+        except queue.Full:
+            with dropped_lock:
+                dropped += 1
+    else:
+        records.put(('record', record))
+
+def rpc_payload(channel, REQorRES, msg):
+    """Apply the channel's sampling and truncation to an rpc payload, or None to skip it"""
+    settings = LOGGING_RPC_PAYLOADS.get(channel, {})
+
+    if REQorRES == 'res':
+        sample = settings.get('sample', 1)
+        rpc_responses[channel] += 1
+        if sample > 1 and rpc_responses[channel] % sample != 1:
+            return None
+
+    msg = str(msg)
+
+    max_length = settings.get('max_length', 0)
+    if max_length and len(msg) > max_length:
+        msg = msg[:max_length] + '... (%d more chars)' % (len(msg) - max_length,)
+
+    return msg
+
+
+def format_record(channel, level, timestamp, msg):
+    if LOGGING_FORMAT == 'json':
+        return json.dumps({'time': ts(timestamp), 'channel': channel, 'level': level, 'message': msg})
+    if channel == 'payoutd':
+        return ts(timestamp) + '[' + level + '] ' + msg
+    return ts(timestamp) + '[' + channel.upper() + '][' + level + '] ' + msg
+
+def open_file(channel):
+    files[channel] = open(os.path.join(LOGGING_PATH, CHANNELS[channel][2]), 'a+')
+
+def open_files():
+    for channel in list(files):
+        files.pop(channel).close()
+    for channel, (console, to_file, name) in CHANNELS.items():
+        if to_file:
+            open_file(channel)
+
+def rotate(channel):
+    """Move channel's log to name.1.gz, shifting older ones up to LOGGING_BACKUPS"""
+    path = os.path.join(LOGGING_PATH, CHANNELS[channel][2])
+    files.pop(channel).close()
+
+    for i in range(LOGGING_BACKUPS - 1, 0, -1):
+        if os.path.exists('%s.%d.gz' % (path, i)):
+            os.replace('%s.%d.gz' % (path, i), '%s.%d.gz' % (path, i + 1))
+
+    if LOGGING_BACKUPS > 0:
+        with open(path, 'rb') as f_in, gzip.open(path + '.1.gz', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(path)
+
+    open_file(channel)
+
+def write_batch(batch):
+    touched = set()
+
+    for channel, level, timestamp, msg, color in batch:
+        console, to_file, name = CHANNELS[channel]
+        line = format_record(channel, level, timestamp, msg)
+        if console:
+            print(color + line + Fore.RESET if color else line)
+        if to_file and channel in files:
+            files[channel].write(line + '\n')
+            touched.add(channel)
+
+    for channel in touched:
+        files[channel].flush()
+        if LOGGING_MAX_SIZE and files[channel].tell() >= LOGGING_MAX_SIZE:
+            rotate(channel)
+
+def take_dropped():
+    global dropped
+    with dropped_lock:
+        n_dropped, dropped = dropped, 0
+    return n_dropped
+
+def writer():
+    while True:
+        batch = []
+        waiting = []
+
+        kind, item = records.get()
+        while True:
+            if kind == 'record':
+                batch.append(item)
+            elif kind == 'flush':
+                waiting.append(item)
+            elif kind == 'reopen':
+                write_batch(batch)
+                batch = []
+                open_files()
+
+            if len(batch) >= BATCH_SIZE:
+                break
+            try:
+                kind, item = records.get_nowait()
+            except queue.Empty:
+                break
+
+        n_dropped = take_dropped()
+        if n_dropped:
+            batch.append(('payoutd', 'ERROR', time.time(), 'Log queue full, dropped %d rpc payload records' % (n_dropped,), Fore.RED))
+
+        try:
+            write_batch(batch)
+            if len(waiting):
+                for f in files.values():
+                    os.fsync(f.fileno())
+        except Exception as e:
+            print('Log writer error: %s' % (e,))
+
+        for done in waiting:
+            done.set()
+
+open_files()
+
+writer_thread = threading.Thread(target=writer, name='log-writer', daemon=True)
+writer_thread.start()
+
+# write out whatever is queued when the process exits
+atexit.register(flush)
 
 
 def message(msg=''):
     """Print out messages"""
-    message = ts() + '[INFO] ' + str(msg)
-    if LOGGING_PAYOUTD_CONSOLE:
-        print(Fore.BLUE + message + Fore.RESET)
-    if LOGGING_PAYOUTD_FILE:
-        PAYOUTD_LOG_FILE.write(message + '\n')
-        PAYOUTD_LOG_FILE.flush()
+    enqueue('payoutd', 'INFO', str(msg), Fore.BLUE)
 
 
 def error(msg=''):
     """Print out error"""
-    message = ts() + '[ERROR] ' + str(msg)
-    if LOGGING_PAYOUTD_CONSOLE:
-        print(Fore.RED + message + Fore.RESET)
-    if LOGGING_PAYOUTD_FILE:
-        PAYOUTD_LOG_FILE.write(message + '\n')
-        PAYOUTD_LOG_FILE.flush()
+    enqueue('payoutd', 'ERROR', str(msg), Fore.RED)
 
 
 def message_wallet_rpc(REQorRES, msg=''):
     """Print out messages for wallet RPC calls"""
-    if REQorRES == 'req':
-        message = ts() + '[WALLET][REQ] ' + str(msg)
-    elif REQorRES == 'res':
-        message = ts() + '[WALLET][RES] ' + str(msg)
-    else:
+    if REQorRES not in ('req', 'res') or not (LOGGING_WALLET_CONSOLE or LOGGING_WALLET_FILE):
         return
 
-    if LOGGING_WALLET_CONSOLE:
-        print(message)
-    if LOGGING_WALLET_FILE:
-        WALLET_LOG_FILE.write(message + '\n')
-        WALLET_LOG_FILE.flush()
+    msg = rpc_payload('wallet', REQorRES, msg)
+    if msg is not None:
+        enqueue('wallet', REQorRES.upper(), msg, droppable=True)
 
 
 def error_wallet_rpc(msg=''):
     """Print out errors for wallet RPC calls"""
-    message = ts() + '[WALLET][ERROR] ' + str(msg)
-    if LOGGING_WALLET_CONSOLE:
-        print(Fore.RED + message + Fore.RESET)
-    if LOGGING_WALLET_FILE:
-        WALLET_LOG_FILE.write(message + '\n')
-        WALLET_LOG_FILE.flush()
+    enqueue('wallet', 'ERROR', str(msg), Fore.RED)
 
 
 def message_daemon_rpc(REQorRES, msg=''):
     """Print out messages for daemon RPC calls"""
-    if REQorRES == 'req':
-        message = ts() + '[DAEMON][REQ] ' + str(msg)
-    elif REQorRES == 'res':
-        message = ts() + '[DAEMON][RES] ' + str(msg)
-    else:
+    if REQorRES not in ('req', 'res') or not (LOGGING_DAEMON_CONSOLE or LOGGING_DAEMON_FILE):
         return
 
-    if LOGGING_DAEMON_CONSOLE:
-        print(message)
-    if LOGGING_DAEMON_FILE:
-        DAEMON_LOG_FILE.write(message + '\n')
-        DAEMON_LOG_FILE.flush()
+    msg = rpc_payload('daemon', REQorRES, msg)
+    if msg is not None:
+        enqueue('daemon', REQorRES.upper(), msg, droppable=True)
 
 
 def error_daemon_rpc(msg=''):
     """Print out errors for daemon RPC calls"""
-    message = ts() + '[DAEMON][ERROR] ' + str(msg)
-    if LOGGING_DAEMON_CONSOLE:
-        print(Fore.RED + message + Fore.RESET)
-    if LOGGING_DAEMON_FILE:
-        DAEMON_LOG_FILE.write(message + '\n')
-        DAEMON_LOG_FILE.flush()
+    enqueue('daemon', 'ERROR', str(msg), Fore.RED)
@@ -0,0 +1,154 @@
+import sys, time, threading
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from .constants import *
+
+# histogram buckets in seconds
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# name -> (type, help)
+METRICS = {
+    'payoutd_stage_duration_seconds': ('histogram', 'Duration of each main loop stage'),
+    'payoutd_rpc_duration_seconds': ('histogram', 'Latency of RPC calls by endpoint and method'),
+    'payoutd_rpc_errors_total': ('counter', 'Failed RPC calls by endpoint and method'),
+    'payoutd_db_queries_total': ('counter', 'Database statements by call site'),
+    'payoutd_db_query_seconds_total': ('counter', 'Time spent in database statements by call site'),
+    'payoutd_db_rows_written_total': ('counter', 'Rows inserted, updated or deleted by call site'),
+    'payoutd_wallet_balance': ('gauge', 'Wallet balance in atomic units'),
+    'payoutd_wallet_unlocked_balance': ('gauge', 'Wallet unlocked balance in atomic units'),
+    'payoutd_owed_confirmed': ('gauge', 'Matured balance owed to users in atomic units'),
+    'payoutd_owed_pending': ('gauge', 'Pending balance owed to users in atomic units'),
+    'payoutd_pending_payments': ('gauge', 'Payments waiting to mature'),
+    'payoutd_consolidation_fees': ('gauge', 'Total fee paid by the pool for consolidation sweeps in atomic units'),
+}
+
+lock = threading.Lock()
+
+# (name, labels) -> value, labels is a tuple of (key, value) pairs
+values = {}
+# (name, labels) -> [count per bucket..., count, sum]
+histograms = {}
+
+server = None
+
+def to_labels(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+def inc(name, labels=None, value=1):
+    if not METRICS_ENABLED:
+        return
+    key = (name, to_labels(labels))
+    with lock:
+        values[key] = values.get(key, 0) + value
+
+def set_gauge(name, value, labels=None):
+    if not METRICS_ENABLED:
+        return
+    with lock:
+        values[(name, to_labels(labels))] = value
+
+def observe(name, value, labels=None):
+    if not METRICS_ENABLED:
+        return
+    key = (name, to_labels(labels))
+    with lock:
+        if key not in histograms:
+            histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+        histogram = histograms[key]
+        for i, bound in enumerate(DURATION_BUCKETS):
+            if value <= bound:
+                histogram[i] += 1
+        histogram[-2] += 1
+        histogram[-1] += value
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as a main loop stage"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe('payoutd_stage_duration_seconds', time.time() - start, {'stage': name})
+
+def call_site(depth):
+    """module.function of the caller depth frames up"""
+    frame = sys._getframe(depth + 1)
+    return '%s.%s' % (frame.f_globals.get('__name__', '?').rsplit('.', 1)[-1], frame.f_code.co_name)
+
+def observe_query(site, query, duration, rows_written):
+    if not METRICS_ENABLED:
+        return
+    labels = (('site', site),)
+    with lock:
+        values[('payoutd_db_queries_total', labels)] = values.get(('payoutd_db_queries_total', labels), 0) + 1
+        values[('payoutd_db_query_seconds_total', labels)] = values.get(('payoutd_db_query_seconds_total', labels), 0) + duration
+        if rows_written > 0:
+            values[('payoutd_db_rows_written_total', labels)] = values.get(('payoutd_db_rows_written_total', labels), 0) + rows_written
+
+def format_labels(labels, extra=None):
+    labels = list(labels) + ([extra] if extra else [])
+    if not len(labels):
+        return ''
+    return '{' + ','.join(['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels]) + '}'
+
+def render():
+    """All metrics in Prometheus text format"""
+    with lock:
+        current = dict(values)
+        current_histograms = { key: list(histogram) for key, histogram in histograms.items() }
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+
+        if metric_type == 'histogram':
+            for (key_name, labels), histogram in sorted(current_histograms.items()):
+                if key_name != name:
+                    continue
+                for bound, count in zip(DURATION_BUCKETS, histogram):
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels, ('le', bound)), count))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels, ('le', '+Inf')), histogram[-2]))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), histogram[-2]))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), repr(float(histogram[-1]))))
+        else:
+            for (key_name, labels), value in sorted(current.items()):
+                if key_name == name:
+                    lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not worth a log line each
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server():
+    """Serve /metrics from a background thread"""
+    global server
+
+    if not METRICS_ENABLED or server is not None:
+        return
+
+    server = MetricsServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
@@ -1,19 +1,61 @@
 from time import time
-import json
 import hashlib
 import re
 
-from cryptonote.address import validate
-
 from .constants import *
 from .errors import *
-from . import database, credit, blocks, fee, wallet, daemon, rpc, log
+from . import database, addresses, balances, credit, blocks, fee, planner, wallet, daemon, rpc, metrics, log
+
+# Payout candidates are read from the db this many rows at a time
+PAYOUT_SCAN_BATCH_SIZE = 1000
+
+# txid -> key image hash of the txs seen in the at-risk zone last cycle,
+# kept in tx_hash_cache so a restart does not hash them all again, None
+# until loaded
+tx_hash_cache = None
+
+relays_ready = False
+
+def load_tx_hash_cache():
+    """Create the tx hash cache table if needed and load it"""
+    global tx_hash_cache
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS tx_hash_cache (
+        txid TEXT PRIMARY KEY,
+        txhash TEXT NOT NULL
+    )
+    """)
 
-def record_payment(uid, txid, time, amount, fee):
+    database.execute('SELECT txid, txhash FROM tx_hash_cache')
+    tx_hash_cache = { txid: txhash for txid, txhash in database.fetchall() }
+
+def save_tx_hash_cache(txid_hashes):
+    """Replace the cache with txid_hashes, only writing the difference"""
+    removed = [txid for txid in tx_hash_cache if txid not in txid_hashes]
+    added = [(txid, txhash) for txid, txhash in txid_hashes.items() if txid not in tx_hash_cache]
+
+    if len(removed) or len(added):
+        try:
+            with database.transaction():
+                if len(removed):
+                    database.execute('DELETE FROM tx_hash_cache WHERE txid = ANY(%s)', (removed,))
+                if len(added):
+                    database.execute_values('INSERT INTO tx_hash_cache (txid, txhash) VALUES %s ON CONFLICT (txid) DO NOTHING', added)
+        except database.psycopg2.Error as e:
+            raise Exception(e.pgerror) from None
+
+    tx_hash_cache.clear()
+    tx_hash_cache.update(txid_hashes)
+
+def record_payment(uid, txid, time, amount, fee, txhash=None):
     """Record payment"""
     try:
-        database.execute('INSERT INTO payments (uid, txid, time, amount_paid, amount_fee, status) VALUES (%s, %s, %s, %s, %s, %s)',
-                         (uid, txid, time, amount, fee, PAYMENT_STATUS_PENDING))
+        balances.ensure_ledger()
+        with database.transaction():
+            database.execute('INSERT INTO payments (uid, txid, txhash, time, amount_paid, amount_fee, status) VALUES (%s, %s, %s, %s, %s, %s, %s)',
+                             (uid, txid, txhash, time, amount, fee, PAYMENT_STATUS_PENDING))
+            balances.add_payment(uid, amount, fee)
         log.message('Recorded payment for user %s, txid: %s, time: %s, amount: %s, fee: %s' % (uid, txid, time, amount, fee))
         return True
     except database.psycopg2.Error as e:
@@ -26,7 +68,9 @@ def record_payment(uid, txid, time, amount, fee):
 def update_payment_status(pymt_id, txid, txhash, status):
     """Change payment status"""
     try:
-        database.execute("UPDATE payments SET txid=%s, txhash=%s, status=%s WHERE pymt_id=%s", (txid, txhash, status, pymt_id))
+        with database.transaction():
+            balances.change_payment(pymt_id, status=status)
+            database.execute("UPDATE payments SET txid=%s, txhash=%s, status=%s WHERE pymt_id=%s", (txid, txhash, status, pymt_id))
         log.message('Updated payment status for pymt %s, txid: %s, txhash: %s, status: %s' % (pymt_id, txid, txhash, status))
         return True
     except database.psycopg2.Error as e:
@@ -39,7 +83,9 @@ def update_payment_status(pymt_id, txid, txhash, status):
 def update_failed_payment_status(pymt_id, txid, txhash, amount_fee):
     """Change payment status for payments with null txid"""
     try:
-        database.execute("UPDATE payments SET txid=%s, txhash=%s, amount_fee=%s WHERE pymt_id=%s", (txid, txhash, amount_fee, pymt_id))
+        with database.transaction():
+            balances.change_payment(pymt_id, amount_fee=amount_fee)
+            database.execute("UPDATE payments SET txid=%s, txhash=%s, amount_fee=%s WHERE pymt_id=%s", (txid, txhash, amount_fee, pymt_id))
         log.message('Updated null payment %s, txid: %s, txhash: %s, fee: %s' % (pymt_id, txid, txhash, amount_fee))
         return True
     except database.psycopg2.Error as e:
@@ -61,74 +107,184 @@ def get_pending_payments():
         log.error(e)
         return []
 
-def get_balances_and_thresholds():
-    """Get users sum of credits, sum of payment, user threshold and wallet address"""
+def key_image_hash(output_keys):
+    """sha256 of the concatenated output keys, stays the same if the txid is malleated"""
+    return hashlib.sha256(bytes.fromhex(''.join(output_keys))).hexdigest()
+
+def ensure_relays():
+    """Create the table holding txs that are built and recorded but not relayed yet"""
+    global relays_ready
+
+    if relays_ready:
+        return
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS payment_relays (
+        txid TEXT PRIMARY KEY,
+        time BIGINT NOT NULL,
+        tx_metadata TEXT NOT NULL,
+        key_images TEXT[] NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    relays_ready = True
+
+def record_built_transaction(recipients, txid, txhash, now, fee_per_user, tx_metadata, key_images):
+    """Record the payments of a built tx and its relay metadata in one db transaction"""
+    ensure_relays()
     try:
-        query = """
-        SELECT
-        info.uid,
-        info.wallet,
-        info.payment_threshold,
-        COALESCE(credits_pending.sum, 0),
-        COALESCE(credits_matured.sum, 0),
-        COALESCE(debits.sum, 0)
-        FROM (
-          SELECT
-          uid,
-          payment_threshold,
-          wallet
-          FROM users
-        ) AS info
-        LEFT JOIN (
-          SELECT
-          uid,
-          SUM(
-            COALESCE(amount_reward, 0) +
-            COALESCE(amount_bonus, 0) +
-            COALESCE(amount_dev, 0)
-          ) AS sum
-          FROM credits
-          WHERE status = 0
-          GROUP BY uid
-        ) AS credits_pending ON credits_pending.uid = info.uid
-        LEFT JOIN (
-          SELECT
-          uid,
-          SUM(
-            COALESCE(amount_reward, 0) +
-            COALESCE(amount_bonus, 0) +
-            COALESCE(amount_dev, 0)
-          ) AS sum
-          FROM credits
-          WHERE status = 1
-          GROUP BY uid
-        ) AS credits_matured ON credits_matured.uid = info.uid
-        LEFT JOIN (
-          SELECT
-          uid,
-          SUM(
-            COALESCE(payments.amount_paid, 0) +
-            COALESCE(payments.amount_fee, 0)
-          ) AS sum
-          FROM payments
-          WHERE status <> -1
-          GROUP BY uid
-        ) AS debits ON debits.uid = info.uid
-        """
-
-        database.execute(query)
+        with database.transaction():
+            for recipient in recipients:
+                uid = recipient['uid']
+                amount = recipient['amount']
+
+                # record payment and fee
+                log.message('Debit user %s (amount, fee): %s %s' % (uid, amount, fee_per_user))
+                if not record_payment(uid, txid, now, amount, fee_per_user, txhash):
+                    raise Exception('Failed to record payment for user %d' % (uid,))
+
+            database.execute('INSERT INTO payment_relays (txid, time, tx_metadata, key_images) VALUES (%s, %s, %s, %s)',
+                             (txid, now, tx_metadata, key_images))
+        log.flush()
+        return True
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+    except Exception as e:
+        log.error('Failed to record built transaction %s' % (txid,))
+        log.error(e)
+        return False
 
+def get_unrelayed():
+    """Get txid, tx_metadata, key_images and attempts of txs not relayed yet"""
+    ensure_relays()
+    try:
+        database.execute('SELECT txid, tx_metadata, key_images, attempts FROM payment_relays ORDER BY time ASC, txid ASC')
         return database.fetchall()
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+def relay_pending():
+    """
+    Relay every recorded tx that has not been relayed yet
+
+    A tx the daemon already knows is counted as relayed, which covers a
+    crash between relay_tx and deleting its row. A tx that keeps failing
+    is abandoned after PAYMENTS_RELAY_MAX_ATTEMPTS: its metadata is
+    deleted so it can never be sent, and its payments are orphaned so the
+    users are paid again.
+    """
+    relayed = 0
+
+    for txid, tx_metadata, key_images, attempts in get_unrelayed():
+        try:
+            txid_relayed = wallet.relay_tx(tx_metadata)
+            log.message('Relayed transaction %s' % (txid_relayed,))
+            log.flush()
+        except rpc.RpcError as re:
+            log.error('Error relaying transaction %s, reason: %s' % (txid, re))
+
+            try:
+                known = len(daemon.get_transactions([txid])) > 0
+            except rpc.RpcError:
+                raise RecoverableError('Failed to call daemon get_transactions') from None
+
+            if not known:
+                attempts += 1
+                if attempts < PAYMENTS_RELAY_MAX_ATTEMPTS:
+                    try:
+                        database.execute('UPDATE payment_relays SET attempts = %s WHERE txid = %s', (attempts, txid))
+                    except database.psycopg2.Error as e:
+                        raise Exception(e.pgerror) from None
+                    continue
+                abandon_transaction(txid)
+                thaw_inputs(txid, key_images)
+                continue
+
+            log.message('Transaction %s is already known to the daemon' % (txid,))
+
+        try:
+            database.execute('DELETE FROM payment_relays WHERE txid = %s', (txid,))
+        except database.psycopg2.Error as e:
+            raise Exception(e.pgerror) from None
+        relayed += 1
 
+        # the wallet marked these spent when it relayed the tx
+        thaw_inputs(txid, key_images)
+
+    return relayed
+
+def thaw_inputs(txid, key_images):
+    try:
+        wallet.thaw(key_images)
+    except rpc.RpcError as re:
+        log.error('Failed to thaw the inputs of transaction %s, reason: %s' % (txid, re))
+
+def abandon_transaction(txid):
+    """Forget an unrelayable tx and orphan its payments"""
+    log.error('Giving up relaying transaction %s after %d attempts, orphaning its payments' % (txid, PAYMENTS_RELAY_MAX_ATTEMPTS))
+    try:
+        with database.transaction():
+            database.execute('DELETE FROM payment_relays WHERE txid = %s', (txid,))
+            database.execute('SELECT pymt_id, txhash FROM payments WHERE txid = %s AND status = %s', (txid, PAYMENT_STATUS_PENDING))
+            for pymt_id, txhash in database.fetchall():
+                if not update_payment_status(pymt_id, txid, txhash, PAYMENT_STATUS_ORPHANED):
+                    raise Exception('Failed to orphan payment %d' % (pymt_id,))
+        log.flush()
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+def get_balances_and_thresholds():
+    """Stream uid, wallet address, threshold and balances of users at or above their threshold"""
+    try:
+        for user in balances.get_payable(PAYOUT_SCAN_BATCH_SIZE):
+            yield user
     except database.psycopg2.Error as e:
         raise Exception(e.pgerror) from None
     except Exception as e:
         log.error('Failed to get balances and thresholds')
         log.error(e)
-        return []
 
-def make_payments():
-    """Pay payments based on credits"""
+def set_balance_gauges(balance, unlocked_balance, total_matured, total_pending, consolidation_fees):
+    metrics.set_gauge('payoutd_wallet_balance', balance)
+    metrics.set_gauge('payoutd_wallet_unlocked_balance', unlocked_balance)
+    metrics.set_gauge('payoutd_owed_confirmed', total_matured)
+    metrics.set_gauge('payoutd_owed_pending', total_pending)
+    metrics.set_gauge('payoutd_consolidation_fees', consolidation_fees)
+
+def update_balance_gauges():
+    """Refresh the balance gauges outside of a payout"""
+    balance, unlocked_balance = wallet.get_balance()
+    total_matured, total_pending = balances.get_totals()
+    set_balance_gauges(balance, unlocked_balance, total_matured, total_pending, balances.get_consolidation_fees())
+
+def prefetch_payout(height):
+    """
+    Fill the fee estimate and wallet output caches and get the wallet
+    balance for make_payments at height, only using wallet-rpc and the daemon
+    """
+    fee.set_height(height)
+    fee.forget_unspent_outputs()
+
+    def wallet_side():
+        fee.get_unspent_outputs()
+        return wallet.get_balance()
+
+    # the fee estimate comes from the daemon while the wallet is asked for the rest
+    _, balance = rpc.gather([fee.get_fee_per_b, wallet_side])
+    return balance
+
+def make_payments(dry_run=False, wallet_balance=None, height=None):
+    """
+    Pay payments based on credits, with dry_run only print the payout plan
+
+    wallet_balance is (balance, unlocked_balance) from prefetch_payout and
+    height the wallet height of this cycle, the wallet is asked for
+    anything not given
+    """
+
+    # fee estimates are reused for this height only
+    fee.set_height(height if height is not None else wallet.get_wallet_height())
 
     # i.e. [ { uid, addr_type, amount, address }, ... ]
     payments = []
@@ -137,19 +293,15 @@ def make_payments():
 
     users = get_balances_and_thresholds()
 
-    total_matured = 0
-    total_pending = 0
+    total_matured, total_pending = balances.get_totals()
 
     log.message('Building list of payments')
 
     for user in users:
-        uid, wallet_addr, payment_threshold, credits_pending, credits_matured, debits = user
+        uid, wallet_addr, payment_threshold, credits_pending, credits_matured, debits, wallet_checked, wallet_valid, wallet_type = user
 
         confirmed_balance = credits_matured - debits
 
-        total_matured += confirmed_balance
-        total_pending += credits_pending
-
         if confirmed_balance < payment_threshold:
             continue
 
@@ -157,14 +309,14 @@ def make_payments():
         # it is a really large amount, will get "tx not possible"
         amount_to_pay = min(confirmed_balance, PAYMENTS_MAX_PAYMENT_AMOUNT)
 
-        wallet_info = validate(wallet_addr, COIN_ADDRESS_PREFIXES)
+        addr_type = addresses.get_address_type(uid, wallet_addr, wallet_checked, wallet_valid, wallet_type, save=not dry_run)
 
-        if not wallet_info['valid']:
-            log.error('User with uid %d has an invalid address %s, skipping...' % (uid, wallet_addr))
+        if addr_type is None:
+            # invalid address, reported when it was first seen
             continue
 
         # Append to payments array
-        payments.append({ 'uid': uid, 'addr_type': wallet_info['type'], 'amount': amount_to_pay, 'address': wallet_addr })
+        payments.append({ 'uid': uid, 'addr_type': addr_type, 'amount': amount_to_pay, 'address': wallet_addr })
 
     # sort payments by lowest amount first
     payments = sorted(payments, key=lambda k: k['amount'])
@@ -173,7 +325,9 @@ def make_payments():
     if not len(payments):
         log.message('No payments need to be made now')
 
-    balance, unlocked_balance = wallet.get_balance()
+    balance, unlocked_balance = wallet_balance if wallet_balance is not None else wallet.get_balance()
+    consolidation_fees = balances.get_consolidation_fees()
+    set_balance_gauges(balance, unlocked_balance, total_matured, total_pending, consolidation_fees)
     net_difference = balance - int(total_matured+total_pending)
     log.message('')
     log.message('Accounting check')
@@ -192,107 +346,128 @@ def make_payments():
     log.message('==========================================================')
     log.message('')
     log.message('Net (balance - owed): %d' % (net_difference,))
+    log.message('Consolidation fees paid by the pool: %d' % (consolidation_fees,))
+    log.message('Net before consolidation fees: %d' % (net_difference + consolidation_fees,))
     log.message('')
 
+    if net_difference < -1 * PAYMENTS_WARNING_THRESHOLD and consolidation_fees > 0:
+        log.error('Consolidation sweeps have cost the pool %d of its margin, see the consolidation_fees table' % (consolidation_fees,))
+
+    if dry_run:
+        if net_difference < -1 * PAYMENTS_WARNING_THRESHOLD:
+            log.error('We owe more than we have in the wallet, a real payout would quit here')
+        planner.compare_plans(payments, unlocked_balance)
+        return
+
     if net_difference < -1 * PAYMENTS_WARNING_THRESHOLD:
         log.error('We owe more than we have in the wallet, quitting...')
         raise CriticalPaymentError()
 
-    out_of_money = False
+    txs, skipped = planner.plan(payments, unlocked_balance)
 
-    # Continue building transactions until we run out of money or payees
-    while not out_of_money and len(payments):
+    for payee in skipped:
+        log.message('Not enough money to pay user %d %d now, skipping' % (payee['uid'], payee['amount']))
 
-        balance, unlocked_balance = wallet.get_balance()
+    # Phase one: build and sign every tx without relaying it, each one is
+    # recorded with its metadata before the next is built. The inputs of
+    # built txs are frozen so the wallet does not pick them again.
+    n_built = 0
+    for recipients in txs:
+
+        running_total = sum([recipient['amount'] for recipient in recipients])
 
         log.message('Building transaction')
         log.message('Wallet has unlocked balance of: %d' % (unlocked_balance))
 
-        # payments that will be made in this transaction
-        recipients = []
-
-        running_total = 0
-
-        if payments[0]['addr_type'] == 'integrated':
-            log.message('This will be an exchange payment')
-            if payments[0]['amount'] <= unlocked_balance:
-                log.message('We have enough money')
-                running_total = payments[0]['amount']
-                recipients = payments.pop(0)
-            else:
-                log.message('We do not have enough money')
-                out_of_money = True
-                break
-        else:
-            log.message('This will be a normal payment')
-            i = 0
-            while len(recipients) < PAYMENTS_MAX_RECIPIENTS and i < len(payments):
-                if payments[i]['addr_type'] == 'integrated':
-                    i += 1
-                    continue
-                if running_total + payments[i]['amount'] <= unlocked_balance:
-                    running_total += payments[i]['amount']
-                    recipients.append(payments.pop(i))
-                else:
-                    out_of_money = True
-                    break
-
-            if not out_of_money:
-                log.message('We have enough money')
-            elif len(recipients):
-                log.message('We have enough money for partial payment')
-            else:
-                log.message('We do not have enough money')
-                break
+        if running_total > unlocked_balance:
+            # change from earlier txs in this payout is still locked
+            log.message('We do not have enough money to pay %d users a total of %d, skipping' % (len(recipients), running_total))
+            continue
 
         log.message('Attempting transaction to pay %d users a total of %d' % (len(recipients), running_total))
+        result = build_transaction(recipients, now)
+        if result is None:
+            continue
 
-        fee_estimated = PAYMENTS_FEE_ADJ_FACTOR * fee.estimate_fee(recipients)
-        fee_per_user = fee.split_fee(fee_estimated, len(recipients))
+        n_built += 1
+        # build_transaction took the estimated fee out of each amount, the
+        # wallet spends what was actually sent plus the actual fee
+        unlocked_balance -= sum([recipient['amount'] for recipient in recipients]) + result['fee']
+        fee.forget_unspent_outputs()
 
-        # this will hold recipient info with only amount and address for RPC
-        recipients_rpc = []
+        try:
+            wallet.freeze(result['key_images'])
+        except rpc.RpcError as re:
+            # without freeze the next tx could spend the same outputs
+            log.error('Could not freeze transaction inputs, relaying now, reason: %s' % (re,))
+            relay_pending()
 
-        for recipient in recipients:
-            # subtract estimated fee for each user
-            recipient['amount'] = int(recipient['amount'] - fee_per_user)
+    # Phase two: relay everything recorded above in one go
+    if n_built:
+        log.message('Relaying %d transactions' % (n_built,))
+    relay_pending()
 
-            # push this address into the wallet rpc list
-            recipients_rpc.append({ 'amount': recipient['amount'], 'address': recipient['address'] })
+    fee.log_stats()
 
-        # Make the actual transfer
-        try:
-            result = wallet.transfer(recipients_rpc)
+    # the next payout should see the outputs as they are then
+    fee.forget_unspent_outputs()
 
-            txid = result['tx_hash']
-            fee_actual = result['fee']
-            fee_actual_per_user = fee.split_fee(fee_actual, len(recipients))
+def build_transaction(recipients, now):
+    """Build and sign a transfer to recipients without relaying it, and debit them"""
 
-            log.message('Transaction success with txid %s' % (txid,))
-            log.message('Estimated fee - actual fee: %s - %s = %s' % (fee_estimated, fee_actual, fee_estimated - fee_actual))
+    fee_predicted = fee.estimate_fee(recipients)
+    fee_estimated = PAYMENTS_FEE_ADJ_FACTOR * fee_predicted
+    fee_per_user = fee.split_fee(fee_estimated, len(recipients))
 
-        except rpc.RpcError as re:
-            log.error('Error transferring payment, reason: %s' % (re,))
-            log.error(recipients)
+    # this will hold recipient info with only amount and address for RPC
+    recipients_rpc = []
+
+    for recipient in recipients:
+        # subtract estimated fee for each user
+        recipient['amount'] = int(recipient['amount'] - fee_per_user)
 
-            # If RPC failed, we will still record debit with estimated fee and empty txid
-            txid = None
-            fee_actual_per_user = fee_per_user
+        # push this address into the wallet rpc list
+        recipients_rpc.append({ 'amount': recipient['amount'], 'address': recipient['address'] })
 
-        for recipient in recipients:
-            uid = recipient['uid']
-            amount = recipient['amount']
+    # Build the transfer, nothing leaves the wallet until it is relayed
+    try:
+        result = wallet.transfer(recipients_rpc, do_not_relay=True)
+    except rpc.RpcError as re:
+        # nothing was sent, the users stay owed
+        log.error('Error building payment, reason: %s' % (re,))
+        log.error(recipients)
+        return None
+
+    txid = result['tx_hash']
+    fee_actual = result['fee']
+    fee_actual_per_user = fee.split_fee(fee_actual, len(recipients))
+
+    key_images, output_keys = daemon.parse_tx_prefix(bytes.fromhex(result['tx_blob']))
+    txhash = key_image_hash(output_keys)
+
+    log.message('Transaction built with txid %s' % (txid,))
+    log.message('Estimated fee - actual fee: %s - %s = %s' % (fee_estimated, fee_actual, fee_estimated - fee_actual))
+    fee.record_fee(fee_predicted, fee_actual)
+
+    if not record_built_transaction(recipients, txid, txhash, now, fee_actual_per_user, result['tx_metadata'], key_images):
+        # the tx was never relayed, so nothing was paid, but stop here
+        log.error('Critical: failed to record transaction %s' % (txid,))
+        raise CriticalPaymentError()
 
-            # record payment and fee
-            log.message('Debit user %s (amount, fee): %s %s' % (uid, amount, fee_actual_per_user))
-            if not record_payment(uid, txid, now, amount, fee_actual_per_user):
-                log.error('Critical: failed to record payment for user %d' % (uid,))
-                raise CriticalPaymentError()
+    return { 'txid': txid, 'fee': fee_actual, 'key_images': key_images }
 
 def unlock():
 
+    # finish any relay a restart or an error interrupted
+    relay_pending()
+
+    # txs still waiting to be relayed are not on the network yet
+    unrelayed = set([row[0] for row in get_unrelayed()])
+
     # get all payments in at-risk zone from db
-    payments_db = get_pending_payments()
+    payments_db = [payment for payment in get_pending_payments() if payment[2] not in unrelayed]
+
+    metrics.set_gauge('payoutd_pending_payments', len(payments_db) + len(unrelayed))
 
     if len(payments_db) == 0:
         # nothing to do
@@ -309,31 +484,48 @@ def unlock():
     # dict to hold txids and their destinations
     # If we don't have a txid in db, use this to match by amount
     txids = {}
+    # amount -> txids with a destination of that amount, in wallet order
+    txids_by_amount = {}
     for payment in payments_rpc:
         txids[payment['txid']] = {
             'destinations': payment['destinations'],
             'fee_per_user': fee.split_fee(payment['fee'], len(payment['destinations']))
         }
+        for recipient in payment['destinations']:
+            txids_by_amount.setdefault(recipient['amount'], []).append(payment['txid'])
 
-    # get the tx info from daemon
-    transactions = daemon.get_transactions(list(txids.keys()))
+    if tx_hash_cache is None:
+        load_tx_hash_cache()
+
+    # txid -> tx hash for every tx we already know the hash of
+    # the hash only depends on the tx outputs, so it never changes for a txid
+    known_hashes = dict(tx_hash_cache)
+    for pymt_id, tx_hash, txid, amount_paid in payments_db:
+        if txid is not None and tx_hash is not None:
+            known_hashes[txid] = tx_hash
 
     # dict to hold tx hashes and their txid
     tx_hashes = {}
+    # reverse of tx_hashes, txid -> tx hash
+    txid_hashes = {}
 
     # calculate txhash from all payments in rpc
-    for transaction in transactions:
+    # the tx info is streamed from daemon, only txs we have not hashed yet are parsed
+    for transaction in daemon.iter_transactions(list(txids.keys())):
         txid = transaction['tx_hash']
         block_height = transaction.get('block_height', 0)
-        tx_as_json = json.loads(transaction['as_json'])
-
-        # concats all the output key images in this tx
-        k_image_concat = ''.join([vout['target']['key'] for vout in tx_as_json['vout']])
 
-        # hash key images with sha256
-        tx_hash = hashlib.sha256(bytes.fromhex(k_image_concat)).hexdigest()
+        if txid in known_hashes:
+            tx_hash = known_hashes[txid]
+        else:
+            # hash the output key images in this tx
+            tx_hash = key_image_hash(daemon.get_output_keys(transaction))
 
         tx_hashes[tx_hash] = [txid, block_height]
+        txid_hashes[txid] = tx_hash
+
+    # keep hashes for the txs still in the at-risk zone
+    save_tx_hash_cache(txid_hashes)
 
     needs_rescan = False
 
@@ -348,10 +540,7 @@ def unlock():
 
         if tx_hash is None:
             # we just submitted this payment, find the tx hash
-            for key, val in tx_hashes.items():
-                if val[0] == txid:
-                    tx_hash = key
-                    break
+            tx_hash = txid_hashes.get(txid)
 
             if tx_hash is None:
                 # if new tx is not found in daemon, we need to skip for now
@@ -397,13 +586,13 @@ def unlock():
 
         log.message('Payment %s has null txid, attempting to fix' % (pymt_id,))
 
-        # Search through txid dict to match this payment by amount_paid
-        for txid_search in txids:
-            for recipient in txids[txid_search]['destinations']:
-                if amount_paid == recipient['amount']:
-                    txid = txid_search
-                    fee_per_user = txids[txid_search]['fee_per_user']
-                    break
+        # Match this payment by amount_paid against the unaccounted txids,
+        # the last matching tx in wallet order wins
+        for txid_search in reversed(txids_by_amount.get(amount_paid, [])):
+            if txid_search in txids:
+                txid = txid_search
+                fee_per_user = txids[txid_search]['fee_per_user']
+                break
 
         if txid is None:
             # we still have no txid, skip
@@ -413,10 +602,7 @@ def unlock():
         log.message('Found txid for null payment %s, %s' % (pymt_id,txid))
 
         # Find the tx_hash
-        for key, val in tx_hashes.items():
-            if val[0] == txid:
-                tx_hash = key
-                break
+        tx_hash = txid_hashes.get(txid)
 
         if tx_hash is None:
             # if new tx is not found in daemon, we need to skip for now
@@ -427,8 +613,5 @@ def unlock():
 
 
     if needs_rescan:
-        log.message('Rescanning wallet')
-        if wallet.rescan_bc():
-            log.message('Rescan complete')
-        else:
-            log.error('Rescan error')
+        log.message('Starting wallet recovery from height %d' % (start_height,))
+        wallet.start_recovery(start_height)
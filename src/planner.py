@@ -0,0 +1,117 @@
+from math import ceil
+
+from .constants import *
+from . import fee, log
+
+# Payout planners take the list of payees, each { uid, addr_type, amount, address },
+# and the unlocked balance, and return (txs, skipped) where txs is a list of
+# recipient lists in the order they should be sent.
+
+def plan_greedy(payees, unlocked_balance):
+    """
+    The original algorithm: fill each tx with the smallest payees until
+    max_recipients, integrated addresses alone, stopping at the first
+    payee that does not fit
+    """
+    payees = sorted(payees, key=lambda k: k['amount'])
+    txs = []
+
+    while len(payees):
+        recipients = []
+        running_total = 0
+        out_of_money = False
+
+        if payees[0]['addr_type'] == 'integrated':
+            if payees[0]['amount'] <= unlocked_balance:
+                running_total = payees[0]['amount']
+                recipients.append(payees.pop(0))
+            else:
+                out_of_money = True
+        else:
+            i = 0
+            while len(recipients) < PAYMENTS_MAX_RECIPIENTS and i < len(payees):
+                if payees[i]['addr_type'] == 'integrated':
+                    i += 1
+                    continue
+                if running_total + payees[i]['amount'] <= unlocked_balance:
+                    running_total += payees[i]['amount']
+                    recipients.append(payees.pop(i))
+                else:
+                    out_of_money = True
+                    break
+
+        if len(recipients):
+            txs.append(recipients)
+            unlocked_balance -= running_total
+
+        if out_of_money or not len(recipients):
+            break
+
+    return txs, payees
+
+def plan_packed(payees, unlocked_balance):
+    """
+    Pay as many payees as the balance allows with the fewest txs
+
+    Payees are taken smallest first and any that do not fit are skipped
+    rather than ending the payout. Normal payees are spread evenly over
+    the fewest txs max_recipients allows, integrated addresses carry a
+    payment id and still need a tx each. Fuller txs go first.
+    """
+    selected = []
+    skipped = []
+
+    for payee in sorted(payees, key=lambda k: k['amount']):
+        if payee['amount'] <= unlocked_balance:
+            selected.append(payee)
+            unlocked_balance -= payee['amount']
+        else:
+            skipped.append(payee)
+
+    normal = [payee for payee in selected if payee['addr_type'] != 'integrated']
+    integrated = [payee for payee in selected if payee['addr_type'] == 'integrated']
+
+    txs = []
+
+    if len(normal):
+        n_txs = int(ceil(len(normal) / PAYMENTS_MAX_RECIPIENTS))
+        txs = [normal[i::n_txs] for i in range(n_txs)]
+
+    txs += [[payee] for payee in integrated]
+
+    txs.sort(key=lambda tx: (-len(tx), sum([payee['amount'] for payee in tx])))
+
+    return txs, skipped
+
+PLANNERS = {
+    'greedy': plan_greedy,
+    'packed': plan_packed
+}
+
+def plan(payees, unlocked_balance, planner=None):
+    return PLANNERS[planner or PAYMENTS_PLANNER](payees, unlocked_balance)
+
+def log_plan(name, txs, skipped):
+    """Print a plan and return its estimated total fee"""
+    total_fee = 0
+    log.message('Plan %s: %d txs paying %d users, %d skipped' % (name, len(txs), sum([len(tx) for tx in txs]), len(skipped)))
+    for idx, tx in enumerate(txs):
+        tx_fee = fee.estimate_fee(tx)
+        total_fee += tx_fee
+        log.message('  tx %d: %d recipients, total %d, estimated fee %d, uids %s' % (
+            idx + 1, len(tx), sum([payee['amount'] for payee in tx]), tx_fee, [payee['uid'] for payee in tx]))
+    for payee in skipped:
+        log.message('  skipped uid %d, amount %d' % (payee['uid'], payee['amount']))
+    log.message('Plan %s: estimated total fee %d' % (name, total_fee))
+    return total_fee
+
+def compare_plans(payees, unlocked_balance):
+    """Print the configured plan next to the greedy one"""
+    txs, skipped = plan(payees, unlocked_balance)
+    fee_planned = log_plan(PAYMENTS_PLANNER, txs, skipped)
+
+    greedy_txs, greedy_skipped = plan_greedy(payees, unlocked_balance)
+    fee_greedy = log_plan('greedy', greedy_txs, greedy_skipped)
+
+    log.message('Fee saving against greedy: %d, users paid: %d vs %d' % (
+        fee_greedy - fee_planned, sum([len(tx) for tx in txs]), sum([len(tx) for tx in greedy_txs])))
@@ -0,0 +1,191 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .constants import *
+from . import database, shares, log
+
+# The engine keeps this many times the largest window seen so far in
+# memory, anything older is dropped
+TRIM_FACTOR = 2
+
+# Share rows (time, uid index, count) sorted by time, one row per (time, uid)
+# Rows are complete for tail_time <= time < head_time
+times = None
+uid_idx = None
+counts = None
+# cumulative share count before each row
+cum_before = None
+
+tail_time = None
+head_time = None
+
+uid_index = {}
+uid_list = []
+
+# largest window in shares requested so far
+max_window = 0
+
+def enabled():
+    return PPLNS_ENGINE == 'numpy' and np is not None
+
+def loaded():
+    return times is not None
+
+def to_index(uid):
+    if uid not in uid_index:
+        uid_index[uid] = len(uid_list)
+        uid_list.append(uid)
+    return uid_index[uid]
+
+def fetch_rows(start_time, end_time):
+    """Read share rows in [start_time, end_time) into arrays"""
+    database.execute("""
+    SELECT time, uid, SUM(count)
+    FROM valid_shares
+    WHERE time >= %s AND time < %s
+    GROUP BY time, uid
+    ORDER BY time ASC
+    """, (start_time, end_time))
+    rows = database.fetchall()
+
+    new_times = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    new_uid_idx = np.fromiter((to_index(row[1]) for row in rows), dtype=np.int64, count=len(rows))
+    new_counts = np.fromiter((int(row[2]) for row in rows), dtype=np.int64, count=len(rows))
+    return new_times, new_uid_idx, new_counts
+
+def set_rows(new_times, new_uid_idx, new_counts):
+    global times, uid_idx, counts, cum_before
+    times, uid_idx, counts = new_times, new_uid_idx, new_counts
+    cum_before = np.cumsum(counts) - counts
+
+def update(now):
+    """Load share rows that settled since the last update"""
+    global head_time
+
+    if not enabled():
+        return
+
+    end_time = (now - shares.SETTLE_SECONDS) // shares.BUCKET_SECONDS * shares.BUCKET_SECONDS
+
+    if not loaded():
+        # the first window lookup decides where history starts
+        head_time = end_time
+        return
+
+    if end_time <= head_time:
+        return
+
+    new_times, new_uid_idx, new_counts = fetch_rows(head_time, end_time)
+    set_rows(np.concatenate((times, new_times)),
+             np.concatenate((uid_idx, new_uid_idx)),
+             np.concatenate((counts, new_counts)))
+    head_time = end_time
+
+    trim()
+
+def extend(start_time):
+    """Make sure share rows from start_time onwards are loaded"""
+    global tail_time
+
+    if not enabled() or head_time is None:
+        return
+
+    if not loaded():
+        log.message('PPLNS engine loading shares from %d' % (start_time,))
+        set_rows(*fetch_rows(start_time, head_time))
+        tail_time = start_time
+        return
+
+    if start_time >= tail_time:
+        return
+
+    new_times, new_uid_idx, new_counts = fetch_rows(start_time, tail_time)
+    set_rows(np.concatenate((new_times, times)),
+             np.concatenate((new_uid_idx, uid_idx)),
+             np.concatenate((new_counts, counts)))
+    tail_time = start_time
+
+def trim():
+    """Drop rows older than any window we could be asked for"""
+    global tail_time
+
+    if not len(times) or not max_window:
+        return
+
+    keep_from = cum_before[-1] + counts[-1] - TRIM_FACTOR * max_window
+    if keep_from <= 0:
+        return
+
+    i = int(np.searchsorted(cum_before, keep_from, side='right')) - 1
+    # never split the rows of a single second
+    i = int(np.searchsorted(times, times[i], side='left'))
+    if i == 0:
+        return
+
+    tail_time = int(times[i])
+    set_rows(times[i:], uid_idx[i:], counts[i:])
+
+def get_pplns_window(timestamp, difficulty):
+    """
+    Same result as credit.get_pplns_window_full_scan, or False if the
+    engine is disabled or does not hold enough history
+    """
+    global max_window
+
+    if not enabled():
+        return False
+
+    max_window = max(max_window, difficulty)
+
+    if not loaded() or timestamp >= head_time or timestamp < tail_time:
+        return False
+
+    end = int(np.searchsorted(times, timestamp, side='right'))
+    if end == 0:
+        return False
+
+    end_total = int(cum_before[end - 1] + counts[end - 1])
+    target = end_total - difficulty
+
+    if target <= 0:
+        # window reaches back past the loaded history
+        return False
+
+    i = int(np.searchsorted(cum_before[:end], target, side='left'))
+    if i == end:
+        return None
+
+    # the window can only start on the first row of a second
+    if i > 0 and times[i - 1] == times[i]:
+        i = int(np.searchsorted(times, times[i], side='right'))
+        if i == end:
+            return None
+
+    return int(times[i]), end_total - int(cum_before[i])
+
+def get_user_shares(start_time, end_time):
+    """
+    Same result as credit.get_user_shares_full_scan, or False if the
+    engine is disabled or does not hold the range
+    """
+    if not enabled() or not loaded() or start_time < tail_time or end_time >= head_time:
+        return False
+
+    lo = int(np.searchsorted(times, start_time, side='left'))
+    hi = int(np.searchsorted(times, end_time, side='right'))
+
+    window_idx = uid_idx[lo:hi]
+    window_counts = counts[lo:hi]
+
+    n_rows = np.bincount(window_idx, minlength=len(uid_list))
+
+    if int(window_counts.sum()) < 2**53:
+        # float64 weights are exact below 2**53
+        totals = np.rint(np.bincount(window_idx, weights=window_counts, minlength=len(uid_list))).astype(np.int64)
+    else:
+        totals = np.zeros(len(uid_list), dtype=np.int64)
+        np.add.at(totals, window_idx, window_counts)
+
+    return [(uid_list[i], int(totals[i])) for i in np.nonzero(n_rows)[0]]
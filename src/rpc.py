@@ -1,136 +1,229 @@
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 import json
+import time
 import os
 
 from .constants import *
 from .errors import *
-from . import log
+from . import metrics, log
+
+# Read timeouts in seconds per RPC method, anything not listed uses
+# RPC_DEFAULT_TIMEOUT. Wallet calls that walk the whole wallet history
+# can be fairly slow, everything else should answer quickly.
+RPC_METHOD_TIMEOUTS = {
+    'get_info': 10,
+    'get_version': 10,
+    'get_height': 10,
+    'get_fee_estimate': 10,
+    'get_last_block_header': 10,
+    'get_block_header_by_height': 10,
+    'get_block_headers_range': 60,
+    'get_block': 30,
+    'get_balance': 30,
+    'get_transactions': 120,
+    'get_transfers': 300,
+    'incoming_transfers': 60,
+    'transfer': 300,
+    'sweep_all': 300,
+    'rescan_spent': 600,
+    'refresh': 3600,
+    'rescan_blockchain': 3600,
+}
+RPC_METHOD_TIMEOUTS.update(RPC_TIMEOUTS)
+
+
+class RpcClient:
+    """Keep-alive HTTP client for a single RPC endpoint"""
+
+    def __init__(self, name, host, port, log_message, log_error, auth_loader=None):
+        self.name = name
+        self.base_url = 'http://' + host + ':' + str(port)
+        self.log_message = log_message
+        self.log_error = log_error
+        self.auth_loader = auth_loader
+
+        self.session = requests.Session()
+        self.session.headers.update({'Content-Type': 'application/json'})
+        # pool_block makes callers wait for a pooled connection, so at most
+        # RPC_POOL_SIZE requests are in flight to the endpoint at once
+        self.adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=RPC_POOL_SIZE, pool_block=True)
+        self.session.mount('http://', self.adapter)
+
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def timeout(self, s_method, timeout=None):
+        if timeout is None:
+            timeout = RPC_METHOD_TIMEOUTS.get(s_method, RPC_DEFAULT_TIMEOUT)
+        return (RPC_CONNECT_TIMEOUT, timeout)
+
+    def post(self, s_method, path, data, timeout=None):
+        """POST data to path, retrying once with fresh credentials on 401"""
+        if self.session.auth is None and self.auth_loader is not None:
+            # HTTPDigestAuth keeps the last nonce, so reusing the same object
+            # answers the challenge up front instead of on every request
+            self.session.auth = requests.auth.HTTPDigestAuth(*self.auth_loader())
+
+        start = time.time()
+        try:
+            o_rsp = self.session.post(self.base_url + path, data=data, timeout=self.timeout(s_method, timeout))
+            if o_rsp.status_code == requests.codes.unauthorized and self.auth_loader is not None: # pylint: disable=maybe-no-member
+                # credentials may have been rotated, read them again
+                self.session.auth = requests.auth.HTTPDigestAuth(*self.auth_loader())
+                o_rsp = self.session.post(self.base_url + path, data=data, timeout=self.timeout(s_method, timeout))
+        except:
+            self.record(s_method, time.time() - start, True)
+            raise
+
+        self.record(s_method, time.time() - start, o_rsp.status_code != requests.codes.ok) # pylint: disable=maybe-no-member
 
-def check_rpc():
+        if o_rsp.status_code != requests.codes.ok: # pylint: disable=maybe-no-member
+            raise RpcError(o_rsp.reason)
+
+        return o_rsp.json()
+
+    def record(self, s_method, latency, is_error):
+        metrics.observe('payoutd_rpc_duration_seconds', latency, {'endpoint': self.name, 'method': s_method})
+        with self.lock:
+            if s_method not in self.stats:
+                self.stats[s_method] = {'calls': 0, 'errors': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+            stat = self.stats[s_method]
+            stat['calls'] += 1
+            stat['latency_total'] += latency
+            stat['latency_max'] = max(stat['latency_max'], latency)
+            if is_error:
+                stat['errors'] += 1
+
+    def error(self, s_method, e):
+        metrics.inc('payoutd_rpc_errors_total', {'endpoint': self.name, 'method': s_method})
+        self.log_error(e)
+
+    def connects(self):
+        """Number of TCP connections opened to this endpoint so far"""
+        pool = self.adapter.poolmanager.connection_from_url(self.base_url)
+        return pool.num_connections
+
+    def json_rpc(self, s_method, d_params=None, timeout=None):
+        """Call a /json_rpc method"""
+        try:
+            d_rpc_input = {"jsonrpc": "2.0", "id": "0", "method" :  s_method}
+
+            if d_params is not None:
+                d_rpc_input['params'] = d_params
+
+            self.log_message('req', json.dumps(d_rpc_input))
+
+            d_jsn = self.post(s_method, '/json_rpc', json.dumps(d_rpc_input), timeout)
+
+            self.log_message('res', d_jsn)
+
+            if 'error' in d_jsn:
+                raise RpcError(d_jsn['error']['message'])
+
+            return d_jsn['result']
+
+        except RpcError as e:
+            self.error(s_method, e)
+            raise
+        except requests.exceptions.RequestException as e:
+            self.error(s_method, e)
+            raise RpcError(e)
+        except OSError as e:
+            log.message(e)
+            self.error(s_method, e)
+            raise RpcError(e)
+        except:
+            self.error(s_method, 'Unknown')
+            raise RpcError('Unknown')
+
+    def other(self, s_method, d_params=None):
+        """Call a non JSON-RPC endpoint, i.e. /get_transactions"""
+        try:
+            self.log_message('req', 'method: %s params: %s' % (s_method, d_params))
+
+            d_jsn = self.post(s_method, '/' + s_method, json.dumps(d_params))
+
+            self.log_message('res', d_jsn['status'])
+
+            if 'error' in d_jsn:
+                raise RpcError(d_jsn['error']['message'])
+
+            return d_jsn
+
+        except RpcError as e:
+            self.error(s_method, e)
+            raise
+        except requests.exceptions.RequestException as e:
+            self.error(s_method, e)
+            raise RpcError(e)
+        except:
+            self.error(s_method, 'Unknown')
+            raise RpcError('Unknown')
+
+    def log_stats(self):
+        with self.lock:
+            stats = sorted(self.stats.items())
+        log.message('RPC %s: %d connections opened' % (self.name, self.connects()))
+        for s_method, stat in stats:
+            log.message('RPC %s %s: calls %d, errors %d, avg %.3fs, max %.3fs' % (
+                self.name, s_method, stat['calls'], stat['errors'],
+                stat['latency_total'] / stat['calls'], stat['latency_max']))
+
+
+def wallet_auth():
+    """Read wallet-rpc credentials"""
+    if WALLET_RPC_AUTH_METHOD == 'file':
+        with open(WALLET_RPC_AUTH_FILE, 'r') as f:
+            username, password = f.readline().strip().split(':', 1)
+        return username, password
+    return WALLET_RPC_USERNAME, WALLET_RPC_PASSWORD
+
+
+wallet_client = RpcClient('wallet', WALLET_RPC_HOST, WALLET_RPC_PORT, log.message_wallet_rpc, log.error_wallet_rpc, wallet_auth)
+daemon_client = RpcClient('daemon', DAEMON_RPC_HOST, DAEMON_RPC_PORT, log.message_daemon_rpc, log.error_daemon_rpc)
+
+
+def check_rpc(check_wallet=True):
     try:
         daemon_rpc('get_info')
         log.message('Connected to daemon rpc')
-        wallet_rpc('get_version')
-        log.message('Connected to wallet rpc')
+        if check_wallet:
+            wallet_rpc('get_version')
+            log.message('Connected to wallet rpc')
         return True
     except RpcError:
         return False
 
-def wallet_rpc(s_method, d_params=None):
-    """Call wallet RPC"""
-    try:
-        d_headers = {'Content-Type': 'application/json'}
-        d_rpc_input = {"jsonrpc": "2.0", "id": "0", "method" :  s_method}
-
-        if d_params is not None:
-            d_rpc_input['params'] = d_params
-
-        log.message_wallet_rpc('req', json.dumps(d_rpc_input))
-
-        if WALLET_RPC_AUTH_METHOD == 'file':
-            with open(WALLET_RPC_AUTH_FILE, 'r') as f:
-                username, password = f.readline().split(':')
-        else:
-            username, password = [WALLET_RPC_USERNAME, WALLET_RPC_PASSWORD]
+def log_stats():
+    wallet_client.log_stats()
+    daemon_client.log_stats()
 
-        o_rsp = requests.post('http://' + WALLET_RPC_HOST + ':' + str(WALLET_RPC_PORT) + '/json_rpc',
-                              data=json.dumps(d_rpc_input),
-                              headers=d_headers,
-                              timeout=300.0, # Wallet can be fairly slow for large requests
-                              auth=requests.auth.HTTPDigestAuth(WALLET_RPC_USERNAME, WALLET_RPC_PASSWORD))
+def gather(calls):
+    """
+    Run independent calls, each a function taking no arguments, on threads
+    and return their results in order
 
-        if o_rsp.status_code != requests.codes.ok: # pylint: disable=maybe-no-member
-            raise RpcError(o_rsp.reason)
+    Every call finishes before the first error is raised, so nothing is
+    left running in the background.
+    """
+    if len(calls) == 1:
+        return [calls[0]()]
 
-        d_jsn = o_rsp.json()
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        futures = [executor.submit(call) for call in calls]
+        wait(futures)
+    return [future.result() for future in futures]
 
-        log.message_wallet_rpc('res', d_jsn)
-
-        if 'error' in d_jsn:
-            raise RpcError(d_jsn['error']['message'])
-
-        return d_jsn['result']
-
-    except RpcError as e:
-        log.error_wallet_rpc(e)
-        raise
-    except requests.exceptions.RequestException as e:
-        log.error_wallet_rpc(e)
-        raise RpcError(e)
-    except OSError as e:
-        log.message(e)
-        log.error_wallet_rpc(e)
-        raise RpcError(e)
-    except:
-        log.error_wallet_rpc('Unknown')
-        raise RpcError('Unknown')
+def wallet_rpc(s_method, d_params=None, timeout=None):
+    """Call wallet RPC"""
+    return wallet_client.json_rpc(s_method, d_params, timeout)
 
 def daemon_rpc(s_method, d_params=None):
-    try:
-        d_headers = {'Content-Type': 'application/json'}
-        d_daemon_input = {"jsonrpc": "2.0", "id": "0", "method" :  s_method}
-
-        if d_params is not None:
-            d_daemon_input['params'] = d_params
-
-        log.message_daemon_rpc('req', d_daemon_input)
-
-        o_rsp = requests.post('http://' + DAEMON_RPC_HOST + ':' + str(DAEMON_RPC_PORT) + '/json_rpc',
-                              data=json.dumps(d_daemon_input),
-                              headers=d_headers,
-                              timeout=300.0)
-
-        if o_rsp.status_code != requests.codes.ok: # pylint: disable=maybe-no-member
-            raise RpcError(o_rsp.reason)
-
-        d_jsn = o_rsp.json()
-
-        log.message_daemon_rpc('res', d_jsn)
-
-        if 'error' in d_jsn:
-            raise RpcError(d_jsn['error']['message'])
-
-        return d_jsn['result']
-
-    except RpcError as e:
-        log.error_daemon_rpc(e)
-        raise
-    except requests.exceptions.RequestException as e:
-        log.error_daemon_rpc(e)
-        raise RpcError(e)
-    except:
-        log.error_daemon_rpc('Unknown')
-        raise RpcError('Unknown')
+    """Call daemon RPC"""
+    return daemon_client.json_rpc(s_method, d_params)
 
 def daemon_rpc_other(s_method, d_params=None):
-    try:
-        d_headers = {'Content-Type': 'application/json'}
-
-        log.message_daemon_rpc('req', 'method: %s params: %s' % (s_method, d_params))
-
-        o_rsp = requests.post('http://' + DAEMON_RPC_HOST + ':' + str(DAEMON_RPC_PORT) + '/' + s_method,
-                              data=json.dumps(d_params),
-                              headers=d_headers,
-                              timeout=300.0)
-
-        if o_rsp.status_code != requests.codes.ok: # pylint: disable=maybe-no-member
-            raise RpcError(o_rsp.reason)
-
-        d_jsn = o_rsp.json()
-
-        log.message_daemon_rpc('res', d_jsn['status'])
-
-        if 'error' in d_jsn:
-            raise RpcError(d_jsn['error']['message'])
-
-        return d_jsn
-
-    except RpcError as e:
-        log.error_daemon_rpc(e)
-        raise
-    except requests.exceptions.RequestException as e:
-        log.error_daemon_rpc(e)
-        raise RpcError(e)
-    except:
-        log.error_daemon_rpc('Unknown')
-        raise RpcError('Unknown')
+    """Call daemon RPC on a non JSON-RPC endpoint"""
+    return daemon_client.other(s_method, d_params)
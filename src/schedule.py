@@ -0,0 +1,72 @@
+from .constants import *
+from .errors import *
+from . import database, wallet, log
+
+# change from a payout is locked for this many blocks
+PAYOUT_MIN_GAP = 10
+
+table_ready = False
+
+def ensure_table():
+    global table_ready
+
+    if table_ready:
+        return
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS payout_height (
+        height BIGINT NOT NULL,
+        time BIGINT NOT NULL
+    )
+    """)
+
+    table_ready = True
+
+def get_last_payout_height():
+    """Get the height of the last payout from db, or None before the first one"""
+    ensure_table()
+    try:
+        database.execute('SELECT MAX(height) FROM payout_height')
+        return database.fetchone()[0]
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+def update_last_payout_height(height, time):
+    """Update last payout height in db"""
+    ensure_table()
+    try:
+        with database.transaction():
+            database.execute('DELETE FROM payout_height')
+            database.execute('INSERT INTO payout_height (height, time) VALUES (%s, %s)', (height, time))
+    except database.psycopg2.Error as e:
+        raise Exception(e.pgerror) from None
+
+def payout_due(height, last_scan_height):
+    """
+    Get the reason a payout is due at height, or None
+
+    A payout is due once the chain crosses a multiple of
+    network_block_interval since the last payout, however many blocks
+    arrived since the last check. Before the first payout the last scan
+    height stands in for it. With min_unlocked_balance set, a payout is
+    also due when the wallet has that much unlocked, as long as the change
+    from the last payout had time to unlock.
+    """
+    last_payout_height = get_last_payout_height()
+    since = last_payout_height if last_payout_height is not None else last_scan_height
+
+    if height // PAYMENTS_NETWORK_BLOCK_INTERVAL > since // PAYMENTS_NETWORK_BLOCK_INTERVAL:
+        boundary = height // PAYMENTS_NETWORK_BLOCK_INTERVAL * PAYMENTS_NETWORK_BLOCK_INTERVAL
+        return 'crossed height %d' % (boundary,)
+
+    if PAYMENTS_MIN_UNLOCKED_BALANCE and (last_payout_height is None or height - last_payout_height >= PAYOUT_MIN_GAP):
+        balance, unlocked_balance = wallet.get_balance()
+        if unlocked_balance >= PAYMENTS_MIN_UNLOCKED_BALANCE:
+            return 'unlocked balance %d' % (unlocked_balance,)
+
+    return None
+
+def blocks_to_next_payout(height):
+    """Blocks until the next interval payout"""
+    blocks = -height % PAYMENTS_NETWORK_BLOCK_INTERVAL
+    return blocks or PAYMENTS_NETWORK_BLOCK_INTERVAL
@@ -0,0 +1,286 @@
+from array import array
+from bisect import bisect_left
+
+from .constants import *
+from . import database, log
+
+# Width in seconds of each share index bucket
+BUCKET_SECONDS = 60
+
+# Shares can land in the db a little after their timestamp, so buckets
+# are only indexed once they are this many seconds in the past
+SETTLE_SECONDS = 120
+
+# Cumulative share index
+# prefix[i] holds the sum of all share counts with time < (first_bucket + i) * BUCKET_SECONDS
+first_bucket = None
+prefix = array('q')
+
+def indexed_until():
+    """Db time up to which the index is complete"""
+    if first_bucket is None:
+        return None
+    return (first_bucket + len(prefix) - 1) * BUCKET_SECONDS
+
+def update_index(now):
+    """Append all settled buckets since the last update to the index"""
+    global first_bucket
+
+    end_bucket = (now - SETTLE_SECONDS) // BUCKET_SECONDS
+
+    if first_bucket is None:
+        database.execute('SELECT MIN(time) FROM valid_shares')
+        min_time = database.fetchone()[0]
+        if min_time is None or min_time // BUCKET_SECONDS >= end_bucket:
+            return
+        first_bucket = min_time // BUCKET_SECONDS
+        prefix.append(0)
+        log.message('Building share index, this can take a while on first run')
+
+    start_bucket = first_bucket + len(prefix) - 1
+
+    if start_bucket >= end_bucket:
+        return
+
+    database.execute("""
+    SELECT time / %s AS bucket, SUM(count)
+    FROM valid_shares
+    WHERE time >= %s AND time < %s
+    GROUP BY bucket
+    ORDER BY bucket ASC
+    """, (BUCKET_SECONDS, start_bucket * BUCKET_SECONDS, end_bucket * BUCKET_SECONDS))
+
+    running_total = prefix[-1]
+    bucket = start_bucket
+    for row_bucket, count in database.fetchall():
+        # fill empty buckets
+        while bucket < row_bucket:
+            bucket += 1
+            prefix.append(running_total)
+        running_total += int(count)
+    while bucket < end_bucket:
+        bucket += 1
+        prefix.append(running_total)
+
+def get_shares_between(start_time, end_time):
+    """Get per second share totals in [start_time, end_time]"""
+    database.execute("""
+    SELECT time, SUM(count)
+    FROM valid_shares
+    WHERE time BETWEEN %s AND %s
+    GROUP BY time
+    ORDER BY time ASC
+    """, (start_time, end_time))
+    return database.fetchall()
+
+def get_first_share_time(start_time, end_time):
+    database.execute('SELECT MIN(time) FROM valid_shares WHERE time BETWEEN %s AND %s', (start_time, end_time))
+    return database.fetchone()[0]
+
+def get_pplns_window(timestamp, difficulty):
+    """
+    Find the PPLNS window start using the index
+
+    Returns the same (time, running_total) as the full scan in
+    credit.get_pplns_window, or False if timestamp is not indexed yet.
+    The running total at a share time t is C(timestamp) - C(t-), where C
+    counts shares up to a time. The window starts at the earliest t with
+    C(t-) >= C(timestamp) - difficulty, which is found by binary search
+    over bucket boundaries and then resolved inside a single bucket.
+    """
+
+    if first_bucket is None or timestamp >= indexed_until():
+        return False
+
+    end_bucket = max(0, timestamp // BUCKET_SECONDS - first_bucket)
+
+    # C(timestamp)
+    end_total = prefix[end_bucket]
+    for _, count in get_shares_between((first_bucket + end_bucket) * BUCKET_SECONDS, timestamp):
+        end_total += int(count)
+
+    target = end_total - difficulty
+
+    # first boundary whose cumulative total reaches the target
+    k = bisect_left(prefix, target, 0, end_bucket + 1)
+
+    if k == 0:
+        # whole history fits in the window
+        start_time = get_first_share_time(0, timestamp)
+        if start_time is None:
+            return None
+        return start_time, end_total
+
+    # resolve inside bucket k - 1
+    bucket_start = (first_bucket + k - 1) * BUCKET_SECONDS
+    bucket_end = min(timestamp, bucket_start + BUCKET_SECONDS - 1)
+
+    running_total = prefix[k - 1]
+    for share_time, count in get_shares_between(bucket_start, bucket_end):
+        if running_total >= target:
+            return share_time, end_total - running_total
+        running_total += int(count)
+
+    if k > end_bucket:
+        # even the newest share is more than difficulty
+        return None
+
+    # window starts at the first share after the bucket
+    start_time = get_first_share_time(bucket_start + BUCKET_SECONDS, timestamp)
+    if start_time is None:
+        return None
+    return start_time, end_total - prefix[k]
+
+# Per uid share rollups
+# share_rollups holds SUM(count) per (uid, minute bucket) for every bucket
+# in [rollup_start, rollup_end), share_rollup_state records that range.
+# payoutd moves end_time forward and manage.py backfill-rollups moves
+# start_time back, possibly at the same time, so both take
+# ROLLUP_LOCK_KEY and read the state from the table before changing it.
+rollup_start = None
+rollup_end = None
+
+# Backfill works backwards through history this many seconds at a time
+ROLLUP_BACKFILL_CHUNK = 86400
+
+# pg_advisory_xact_lock key guarding share_rollup_state
+ROLLUP_LOCK_KEY = 0x70617972
+
+def init_rollups():
+    """Create the rollup tables if needed and load the covered range"""
+    global rollup_start, rollup_end
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS share_rollups (
+        bucket BIGINT NOT NULL,
+        uid INTEGER NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (bucket, uid)
+    )
+    """)
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS share_rollup_state (
+        start_time BIGINT NOT NULL,
+        end_time BIGINT NOT NULL
+    )
+    """)
+
+    database.execute('SELECT start_time, end_time FROM share_rollup_state')
+    row = database.fetchone()
+    if row is not None:
+        rollup_start, rollup_end = row
+
+def lock_rollup_state(end_time):
+    """
+    Lock share_rollup_state until the end of the current transaction and
+    return its (start_time, end_time), starting an empty range at
+    end_time if there is none yet
+    """
+    database.execute('SELECT pg_advisory_xact_lock(%s)', (ROLLUP_LOCK_KEY,))
+    database.execute('SELECT start_time, end_time FROM share_rollup_state')
+    row = database.fetchone()
+    if row is None:
+        # nothing rolled up yet, start from here and let backfill_rollups
+        # take care of the history
+        database.execute('INSERT INTO share_rollup_state (start_time, end_time) VALUES (%s, %s)', (end_time, end_time))
+        return end_time, end_time
+    return row
+
+def rollup_range(start_time, end_time):
+    """Aggregate raw shares in [start_time, end_time) into share_rollups"""
+    # the range comes from the locked state so it never overlaps rolled
+    # up buckets, DO NOTHING is only a guard against a damaged state row
+    database.execute("""
+    INSERT INTO share_rollups (bucket, uid, count)
+    SELECT time / %s, uid, SUM(count)
+    FROM valid_shares
+    WHERE time >= %s AND time < %s
+    GROUP BY 1, 2
+    ON CONFLICT (bucket, uid) DO NOTHING
+    """, (BUCKET_SECONDS, start_time, end_time))
+
+def settled_time(now):
+    return (now - SETTLE_SECONDS) // BUCKET_SECONDS * BUCKET_SECONDS
+
+def update_rollups(now):
+    """Roll up all settled buckets since the last update"""
+    global rollup_start, rollup_end
+
+    if rollup_end is None:
+        init_rollups()
+
+    end_time = settled_time(now)
+
+    # only payoutd moves end_time, so the copy in memory is never ahead of the table
+    if rollup_end is not None and end_time <= rollup_end:
+        return
+
+    with database.transaction():
+        start_time, last_end_time = lock_rollup_state(end_time)
+        if end_time > last_end_time:
+            rollup_range(last_end_time, end_time)
+            database.execute('UPDATE share_rollup_state SET end_time = %s', (end_time,))
+            last_end_time = end_time
+
+    rollup_start, rollup_end = start_time, last_end_time
+
+def backfill_rollups(now):
+    """Roll up existing share history, resumable one chunk at a time"""
+    global rollup_start, rollup_end
+
+    init_rollups()
+
+    database.execute('SELECT MIN(time) FROM valid_shares')
+    min_time = database.fetchone()[0]
+
+    if min_time is None:
+        log.message('No shares to backfill')
+        return
+
+    min_time = min_time // BUCKET_SECONDS * BUCKET_SECONDS
+
+    while True:
+        with database.transaction():
+            start_time, end_time = lock_rollup_state(settled_time(now))
+            if start_time <= min_time:
+                break
+            chunk_start = max(min_time, start_time - ROLLUP_BACKFILL_CHUNK)
+            rollup_range(chunk_start, start_time)
+            database.execute('UPDATE share_rollup_state SET start_time = %s', (chunk_start,))
+        log.message('Backfilled share rollups from %d, %d seconds left' % (chunk_start, chunk_start - min_time))
+
+    rollup_start, rollup_end = start_time, end_time
+    log.message('Share rollups cover %d - %d' % (rollup_start, rollup_end))
+
+def get_user_shares(start_time, end_time):
+    """
+    Get (uid, shares) in [start_time, end_time] from whole rollup
+    buckets plus raw rows for the partial buckets at either edge
+
+    Returns False if the rollups do not cover any whole bucket of the range.
+    """
+    if rollup_start is None:
+        return False
+
+    first_bucket = max(-(-start_time // BUCKET_SECONDS), rollup_start // BUCKET_SECONDS)
+    end_bucket = min((end_time + 1) // BUCKET_SECONDS, rollup_end // BUCKET_SECONDS)
+
+    if first_bucket >= end_bucket:
+        return False
+
+    database.execute("""
+    SELECT uid, SUM(count)
+    FROM (
+        SELECT uid, count FROM valid_shares WHERE time >= %s AND time < %s
+        UNION ALL
+        SELECT uid, count FROM share_rollups WHERE bucket >= %s AND bucket < %s
+        UNION ALL
+        SELECT uid, count FROM valid_shares WHERE time >= %s AND time <= %s
+    ) t
+    GROUP BY uid
+    """, (start_time, first_bucket * BUCKET_SECONDS,
+          first_bucket, end_bucket,
+          end_bucket * BUCKET_SECONDS, end_time))
+
+    # rollups are BIGINT, match the integer sums of the raw query
+    return [(uid, int(count)) for uid, count in database.fetchall()]
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .constants import *
+from .errors import *
+from . import database, metrics, log
+
+# Stages run on a thread pool as soon as the stages they come after are
+# done. There is only one database cursor, so stages that use the
+# database hold database.lock for their whole run and never overlap, and
+# they keep the order given by their dependencies. Stages that only talk
+# to wallet-rpc or the daemon run alongside them.
+
+
+class Stage:
+    def __init__(self, name, func, after=(), uses_db=True, optional=False, message=None):
+        """
+        func is called with the results of the stages run so far, by name.
+        An optional stage that fails is logged and its result is None,
+        any other failure stops the run once the running stages finish.
+        """
+        self.name = name
+        self.func = func
+        self.after = after
+        self.uses_db = uses_db
+        self.optional = optional
+        self.message = message
+
+
+def run_stage(stage, results):
+    if stage.message is not None:
+        log.message(stage.message)
+    with metrics.stage(stage.name):
+        if stage.uses_db:
+            with database.lock:
+                return stage.func(results)
+        return stage.func(results)
+
+def run(stages):
+    """Run stages in dependency order, returns their results by name"""
+    results = {}
+    pending = list(stages)
+    done = set()
+    running = {}
+    error = None
+
+    with ThreadPoolExecutor(max_workers=STAGE_THREADS) as executor:
+        while True:
+            if error is None:
+                for stage in [stage for stage in pending if all([name in done for name in stage.after])]:
+                    pending.remove(stage)
+                    running[executor.submit(run_stage, stage, results)] = stage
+
+            if not len(running):
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    if stage.optional and not isinstance(e, CriticalPaymentError):
+                        log.error('Stage %s failed, continuing without it' % (stage.name,))
+                        log.error(e)
+                        results[stage.name] = None
+                    else:
+                        # a critical payment error wins over anything else
+                        if error is None or isinstance(e, CriticalPaymentError):
+                            error = e
+                        continue
+                done.add(stage.name)
+
+    if error is not None:
+        raise error
+
+    return results
@@ -1,6 +1,18 @@
+import json
+import threading
+import time
+
 from .constants import *
 from .errors import *
-from . import database, rpc
+from . import database, daemon, rpc, log
+
+# Outgoing transfers known to be confirmed in the at-risk zone
+# { start_height, height, block_hash, transfers: { txid: transfer } }
+transfer_cursor = None
+
+# Background wallet recovery after an orphaned payment
+# { stage, start_height, started, deadline, result }
+recovery = None
 
 def get_wallet_height():
     """Get the wallet's current block height"""
@@ -17,8 +29,50 @@ def get_balance():
     except RpcError:
         raise RecoverableError('Failed to call wallet-rpc get_balance') from None
 
-def get_outgoing_transfers(min_height):
-    """Get outgoing transfers starting at min_height"""
+def get_address():
+    """Get the wallet's primary address"""
+    try:
+        return rpc.wallet_rpc('get_address', {'account_index': 0})['address']
+    except RpcError:
+        raise RecoverableError('Failed to call wallet-rpc get_address') from None
+
+def sweep_all(address, below_amount):
+    """Sweep every unlocked output below below_amount to address, returns the txids and fees"""
+    # exceptions are handled in consolidate.py
+    parameters = {
+        'address': address,
+        'account_index': 0,
+        'below_amount': below_amount,
+        'priority': PAYMENTS_PRIORITY,
+        'ring_size': PAYMENTS_RING_SIZE
+    }
+    result = rpc.wallet_rpc('sweep_all', parameters)
+    return result.get('tx_hash_list', []), result.get('fee_list', [])
+
+def get_unspent_amounts():
+    """Get the amounts of the outputs the wallet can spend now"""
+    try:
+        result = rpc.wallet_rpc('incoming_transfers', {'transfer_type': 'available'})
+        return [t['amount'] for t in result.get('transfers', []) if t.get('unlocked', True) and not t.get('frozen', False)]
+    except RpcError:
+        raise RecoverableError('Failed to call wallet-rpc incoming_transfers') from None
+
+def get_block_transfers(min_height, max_height):
+    """Get incoming block reward transfers in (min_height, max_height]"""
+    try:
+        parameters = {
+            'in': True,
+            'filter_by_height': True,
+            'min_height': min_height,
+            'max_height': max_height
+        }
+        result = rpc.wallet_rpc('get_transfers', parameters)
+        return [t for t in result.get('in', []) if t['type'] == 'block']
+    except RpcError:
+        raise RecoverableError('Failed to call wallet-rpc get_transfers') from None
+
+def list_outgoing_transfers(min_height):
+    """Ask wallet-rpc for outgoing transfers above min_height, plus all pending ones"""
     try:
         parameters = {
             'out': True,
@@ -27,32 +81,162 @@ def get_outgoing_transfers(min_height):
             'min_height': min_height
         }
         result = rpc.wallet_rpc('get_transfers', parameters)
-
-        transfers = []
-        if 'pending' in result:
-            transfers += result['pending']
-        if 'out' in result:
-            transfers += result['out']
-
-        return transfers
+        return result.get('out', []), result.get('pending', [])
     except RpcError:
         raise RecoverableError('Failed to call wallet-rpc get_transfers') from None
 
-def transfer(destinations, payment_id=None):
-    """Make a wallet rpc transfer"""
+def load_transfer_cursor():
+    """Create the transfer cursor tables if needed and load them"""
+    global transfer_cursor
+
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_transfers (
+        txid TEXT PRIMARY KEY,
+        height BIGINT NOT NULL,
+        transfer TEXT NOT NULL
+    )
+    """)
+    database.execute("""
+    CREATE TABLE IF NOT EXISTS wallet_transfer_cursor (
+        start_height BIGINT NOT NULL,
+        height BIGINT NOT NULL,
+        block_hash TEXT NOT NULL
+    )
+    """)
+
+    database.execute('SELECT start_height, height, block_hash FROM wallet_transfer_cursor')
+    row = database.fetchone()
+    if row is None:
+        return
+
+    database.execute('SELECT txid, transfer FROM wallet_transfers')
+    transfers = { txid: json.loads(transfer) for txid, transfer in database.fetchall() }
+
+    transfer_cursor = {
+        'start_height': row[0],
+        'height': row[1],
+        'block_hash': row[2],
+        'transfers': transfers
+    }
+
+def save_transfer_cursor(cursor, added, removed, replace=False):
+    """Persist cursor changes in one transaction"""
+    with database.transaction():
+        if replace:
+            database.execute('DELETE FROM wallet_transfers')
+        elif len(removed):
+            database.execute('DELETE FROM wallet_transfers WHERE txid = ANY(%s)', (removed,))
+        if len(added):
+            database.execute_values("""
+            INSERT INTO wallet_transfers (txid, height, transfer) VALUES %s
+            ON CONFLICT (txid) DO UPDATE SET height = EXCLUDED.height, transfer = EXCLUDED.transfer
+            """, [(t['txid'], t['height'], json.dumps(t)) for t in added])
+        database.execute('DELETE FROM wallet_transfer_cursor')
+        database.execute('INSERT INTO wallet_transfer_cursor (start_height, height, block_hash) VALUES (%s, %s, %s)',
+                         (cursor['start_height'], cursor['height'], cursor['block_hash']))
+
+def get_outgoing_transfers(min_height):
+    """
+    Get outgoing transfers starting at min_height
+
+    Confirmed transfers are remembered along with the height they were
+    listed up to, so wallet-rpc is only asked for transfers above that
+    height plus the pending ones. Everything is listed again from
+    min_height if the block at the cursor height changed (a reorg) or
+    min_height moved below what the cursor covers.
+    """
+    global transfer_cursor
+
+    if transfer_cursor is None:
+        load_transfer_cursor()
+
+    wallet_height = get_wallet_height()
+    cursor_height = wallet_height - 1
+
+    try:
+        # drop any cached headers past a fork before comparing hashes
+        daemon.validate_header_cache()
+        cursor_hash = daemon.get_block_header(cursor_height)['hash']
+    except (RpcError, TypeError):
+        raise RecoverableError('Failed to get block header at height %d' % (cursor_height,)) from None
+
+    cursor = transfer_cursor
+    full = cursor is None or min_height < cursor['start_height'] or cursor['height'] > cursor_height
+
+    if not full:
+        try:
+            full = daemon.get_block_header(cursor['height'])['hash'] != cursor['block_hash']
+        except (RpcError, TypeError):
+            raise RecoverableError('Failed to get block header at height %d' % (cursor['height'],)) from None
+        if full:
+            log.message('Block at transfer cursor height %d changed, listing transfers again' % (cursor['height'],))
+
+    if full:
+        outgoing, pending = list_outgoing_transfers(min_height)
+        transfers = {}
+    else:
+        outgoing, pending = list_outgoing_transfers(cursor['height'])
+        transfers = dict(cursor['transfers'])
+
+    added = []
+    for t in outgoing:
+        if t['txid'] not in transfers or transfers[t['txid']] != t:
+            added.append(t)
+        transfers[t['txid']] = t
+
+    # forget transfers that left the at-risk zone
+    removed = [txid for txid, t in transfers.items() if t['height'] <= min_height]
+    for txid in removed:
+        transfers.pop(txid)
+    added = [t for t in added if t['txid'] in transfers]
+
+    transfer_cursor = {
+        'start_height': min_height,
+        'height': cursor_height,
+        'block_hash': cursor_hash,
+        'transfers': transfers
+    }
+    save_transfer_cursor(transfer_cursor, added, removed, replace=full)
+
+    return pending + list(transfers.values())
+
+def transfer(destinations, payment_id=None, do_not_relay=False):
+    """
+    Make a wallet rpc transfer
+
+    With do_not_relay the tx is only built and signed, the result carries
+    tx_blob and tx_metadata and the tx is sent later with relay_tx.
+    """
     # exceptions are handled in payments.py
     parameters = {
         'destinations': destinations,
         'priority': PAYMENTS_PRIORITY,
-        'ring_size': PAYMENTS_RING_SIZE,
-        # 'do_not_relay': True
+        'ring_size': PAYMENTS_RING_SIZE
     }
 
+    if do_not_relay:
+        parameters['do_not_relay'] = True
+        parameters['get_tx_hex'] = True
+        parameters['get_tx_metadata'] = True
+
     if payment_id is not None:
         parameters['payment_id'] = payment_id
 
     return rpc.wallet_rpc('transfer', parameters)
 
+def relay_tx(tx_metadata):
+    """Relay a tx built with do_not_relay, returns its txid"""
+    return rpc.wallet_rpc('relay_tx', {'hex': tx_metadata})['tx_hash']
+
+def freeze(key_images):
+    """Keep the wallet from spending these outputs in the next txs it builds"""
+    for key_image in key_images:
+        rpc.wallet_rpc('freeze', {'key_image': key_image})
+
+def thaw(key_images):
+    for key_image in key_images:
+        rpc.wallet_rpc('thaw', {'key_image': key_image})
+
 def get_at_risk_zone():
     wallet_height = get_wallet_height()
     last_scan_height = get_last_scan_height()
@@ -103,3 +287,83 @@ def rescan_bc():
     except RpcError:
         log.error('Failed to rescan blockchain')
         return False
+
+def recovery_in_progress():
+    return recovery is not None and recovery['result'] is None
+
+def recovery_status():
+    """Describe the background recovery progress"""
+    if recovery is None:
+        return 'No wallet recovery has run'
+    now = time.time()
+    if recovery['result'] is None:
+        return 'Wallet recovery from height %d running %s, %d seconds elapsed, %d seconds to deadline' % (
+            recovery['start_height'], recovery['stage'], now - recovery['started'], max(0, recovery['deadline'] - now))
+    return 'Wallet recovery from height %d finished: %s' % (recovery['start_height'], recovery['result'])
+
+def start_recovery(start_height):
+    """
+    Resync the wallet in the background after an orphaned payment
+
+    Runs rescan_spent, then refresh from start_height. A full
+    rescan_blockchain is only attempted if both fail and
+    recovery_full_rescan is enabled.
+    """
+    global recovery
+
+    if recovery_in_progress():
+        log.message(recovery_status())
+        return False
+
+    now = time.time()
+    recovery = {
+        'stage': 'starting',
+        'start_height': start_height,
+        'started': now,
+        'deadline': now + WALLET_RECOVERY_DEADLINE,
+        'result': None
+    }
+
+    threading.Thread(target=run_recovery, args=(recovery,), daemon=True).start()
+    return True
+
+def run_recovery(state):
+    tiers = [
+        ('rescan_spent', None),
+        ('refresh', {'start_height': state['start_height']})
+    ]
+
+    for method, parameters in tiers:
+        if recovery_tier(state, method, parameters):
+            return
+
+    if WALLET_RECOVERY_FULL_RESCAN and recovery_tier(state, 'rescan_blockchain', None):
+        return
+
+    if state['result'] is None:
+        state['result'] = 'failed'
+    log.error(recovery_status())
+
+def recovery_tier(state, method, parameters):
+    """Run one recovery step, returns True once the wallet is back in sync"""
+    remaining = state['deadline'] - time.time()
+    if remaining <= 0:
+        state['result'] = 'deadline exceeded before %s' % (method,)
+        return False
+
+    state['stage'] = method
+    log.message(recovery_status())
+
+    try:
+        rpc.wallet_rpc(method, parameters, timeout=remaining)
+    except RpcError as e:
+        log.error('Wallet recovery %s failed: %s' % (method, e))
+        return False
+
+    if method == 'rescan_spent':
+        # spent flags are fixed, the refresh still has to pick up the new chain
+        return False
+
+    state['result'] = 'ok after %s, %d seconds' % (method, time.time() - state['started'])
+    log.message(recovery_status())
+    return True
@@ -0,0 +1,93 @@
+import os, shutil
+
+import pytest
+
+# Runs against a scratch Postgres database, i.e.
+# PAYOUTD_TEST_DSN="dbname=payoutd_test user=postgres" python -m pytest tests
+# Everything is created in its own schema, which is dropped afterwards.
+DSN = os.environ.get('PAYOUTD_TEST_DSN')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCHEMA = 'payoutd_test'
+
+pytestmark = pytest.mark.skipif(not DSN, reason='PAYOUTD_TEST_DSN is not set')
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    psycopg2 = pytest.importorskip('psycopg2')
+
+    # src.constants reads config.json and src.log writes to logs/ in the working directory
+    shutil.copy(os.path.join(ROOT, 'config.example.json'), str(tmp_path / 'config.json'))
+    (tmp_path / 'logs').mkdir()
+    monkeypatch.chdir(str(tmp_path))
+    monkeypatch.syspath_prepend(ROOT)
+
+    from src import database, balances, credit, payments
+
+    conn = psycopg2.connect(DSN)
+    conn.set_isolation_level(database.ISOLATION_LEVEL_AUTOCOMMIT)
+    cur = conn.cursor()
+    cur.execute('DROP SCHEMA IF EXISTS ' + SCHEMA + ' CASCADE')
+    cur.execute('CREATE SCHEMA ' + SCHEMA)
+    cur.execute('SET search_path TO ' + SCHEMA)
+    cur.execute("""
+    CREATE TABLE credits (
+        blk_id INTEGER NOT NULL,
+        uid INTEGER NOT NULL,
+        time BIGINT NOT NULL,
+        amount_reward BIGINT,
+        amount_bonus BIGINT,
+        amount_dev BIGINT,
+        status INTEGER NOT NULL
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE payments (
+        pymt_id SERIAL PRIMARY KEY,
+        uid INTEGER NOT NULL,
+        txid TEXT,
+        txhash TEXT,
+        time BIGINT NOT NULL,
+        amount_paid BIGINT,
+        amount_fee BIGINT,
+        status INTEGER NOT NULL
+    )
+    """)
+
+    monkeypatch.setattr(database, 'conn', conn)
+    monkeypatch.setattr(database, 'cur', cur)
+    monkeypatch.setattr(database, 'transaction_depth', 0)
+    monkeypatch.setattr(balances, 'ledger_ready', False)
+
+    yield database, balances, credit, payments
+
+    cur.execute('DROP SCHEMA ' + SCHEMA + ' CASCADE')
+    conn.close()
+
+
+def ledger(database):
+    database.execute('SELECT uid, pending, matured, debited FROM user_balances ORDER BY uid')
+    return database.fetchall()
+
+
+def test_first_credit_into_new_ledger(db):
+    database, balances, credit, payments = db
+
+    # history from before the ledger existed
+    database.execute('INSERT INTO credits (blk_id, uid, time, amount_reward, amount_bonus, amount_dev, status) VALUES (1, 1, 0, 100, 0, 0, 1)')
+
+    credit.record_credits(2, 10, [(1, 50, 5, None), (2, 70, None, None)])
+
+    assert balances.get_drift() == []
+    assert ledger(database) == [(1, 55, 100, 0), (2, 70, 0, 0)]
+
+
+def test_first_payment_into_new_ledger(db):
+    database, balances, credit, payments = db
+
+    database.execute('INSERT INTO credits (blk_id, uid, time, amount_reward, amount_bonus, amount_dev, status) VALUES (1, 1, 0, 100, 0, 0, 1)')
+
+    assert payments.record_payment(1, 'txid', 10, 40, 2, 'txhash')
+
+    assert balances.get_drift() == []
+    assert ledger(database) == [(1, 0, 100, 42)]